@@ -1,25 +1,67 @@
 import os
 import json
 import uuid
+import hashlib
+import threading
 import traceback
-from flask import Flask, request, jsonify
+from functools import partial
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
-from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from layer1_extraction import extract_landmarks
-from layer2_metrics import calculate_metrics
-from layer3_classify import classify_features
-from generation import run_generation
+from cpu_pool import CPUBusy, CPU_RETRY_AFTER, get_cpu_pool, classify_task, render_debug_task
+from layer2_metrics import LANDMARK_INDICES
+from generation import Deadline, run_generation, iter_generation
+from ollama_client import get_router, warm_up_ollama
+from model_tiers import get_model_tiers
+from retrieve import index_knowledge
+from cache import FlightTimeout, create_cache, hash_key
+from jobs import JobQueue, QueueFull, create_backend
+from batch_analysis import BATCH_MAX_IMAGES, MAX_FACES, analyze_batch, analyze_faces
 
 #  Config
 UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), "uploads")
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "webp", "bmp"}
+KNOWLEDGE_PATH = "./knowledge"
+
+# /analyze/debug renders the landmark mesh; off unless explicitly enabled
+DEBUG_ENDPOINT = os.getenv("DEBUG_ENDPOINT", "0") == "1"
+
+# Sparse landmark mode materializes only the landmarks Layer 2 reads
+SPARSE_LANDMARKS = os.getenv("SPARSE_LANDMARKS", "0") == "1"
+LANDMARK_SUBSET = LANDMARK_INDICES if SPARSE_LANDMARKS else None
+
+# Async job API – "memory" is per process; use "sqlite" when several
+# gunicorn workers must see each other's jobs.
+JOB_BACKEND = os.getenv("JOB_BACKEND", "memory")
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", os.path.join(UPLOAD_FOLDER, "jobs.db"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 16))
+JOB_TTL = int(os.getenv("JOB_TTL", 3600))
+JOB_RETRY_AFTER = int(os.getenv("JOB_RETRY_AFTER", 10))
+
+# /analyze results by upload content hash, so re-submitted images skip the
+# pipeline – "memory" (per process), "disk" (shared by workers), "redis"
+# (any Redis-protocol server at RESULT_CACHE_URL) or "off"
+RESULT_CACHE_BACKEND = os.getenv("RESULT_CACHE_BACKEND", "memory")
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 256))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 3600))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(UPLOAD_FOLDER, "result_cache"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+RESULT_CACHE_URL = os.getenv("RESULT_CACHE_URL", "redis://localhost:6379/0")
+
+# /analyze/batch accepts many images, so it gets its own body size limit
+BATCH_MAX_CONTENT_LENGTH = int(os.getenv("BATCH_MAX_CONTENT_LENGTH", 200 * 1024 * 1024))
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+result_cache = None if RESULT_CACHE_BACKEND == "off" else create_cache(
+    RESULT_CACHE_BACKEND, max_entries=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, directory=RESULT_CACHE_DIR,
+    max_bytes=RESULT_CACHE_MAX_BYTES, url=RESULT_CACHE_URL, prefix="glamai:analyze:",
+)
+
 app = Flask(__name__)
 CORS(app)  # allow cross-origin requests from any frontend
 
@@ -27,17 +69,174 @@ app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["MAX_CONTENT_LENGTH"] = 10 * 1024 * 1024  # 10 MB limit
 
 
+
 #  Helpers 
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def read_upload():
+    """Validate the 'image' upload and return (image_bytes, None) or (None, error response)."""
+    if "image" not in request.files:
+        return None, (jsonify({"error": "No image file provided. Send as form-data with key 'image'."}), 400)
+
+    file = request.files["image"]
+
+    if file.filename == "":
+        return None, (jsonify({"error": "Empty filename."}), 400)
+
+    if not allowed_file(file.filename):
+        return None, (jsonify({
+            "error": f"File type not allowed. Accepted: {', '.join(ALLOWED_EXTENSIONS)}"
+        }), 400)
+
+    # Read uploaded image into memory (decoded straight from bytes, never written to disk)
+    image_bytes = file.read()
+    if not image_bytes:
+        return None, (jsonify({"error": "Empty image file."}), 400)
+    return image_bytes, None
+
+
+def classify_image(image_bytes, block=False):
+    """Layers 1–3 on the CPU pool: landmarks → metrics → classified features.
+
+    Raises CPUBusy when the pool is saturated, unless ``block`` waits for it.
+    """
+    return get_cpu_pool().run(classify_task, image_bytes, LANDMARK_SUBSET, block=block)
+
+
+def analyze_image(image_bytes, block=False, deadline=None):
+    """Full pipeline for one image; returns the /analyze response body.
+
+    ``deadline`` is the request's latency budget (a fresh REQUEST_BUDGET_SECONDS
+    one if not given); LLM calls that don't fit in it fall back to template
+    text and are marked degraded.
+    """
+    deadline = deadline or Deadline()
+    #  Layers 1–3 – Extract landmarks, calculate metrics, classify features
+    face_features, human_text = classify_image(image_bytes, block=block)
+
+    # Save face features for generation step
+    features_path = os.path.join(app.config["UPLOAD_FOLDER"], f"{uuid.uuid4().hex}_features.json")
+    with open(features_path, "w", encoding="utf-8") as f:
+        json.dump(face_features, f, indent=4)
+
+    #  Generation – RAG + LLM recommendations 
+    recommendations = run_generation(
+        face_features_path=features_path,
+        knowledge_path=KNOWLEDGE_PATH,
+        output_path=os.path.join(app.config["UPLOAD_FOLDER"], f"{uuid.uuid4().hex}_recommendations.json"),
+        deadline=deadline
+    )
+
+    #  Build response 
+    return {
+        "success": True,
+        "face_features": face_features,
+        "human_readable": human_text,
+        "recommendations": recommendations,
+        "degraded": any(r.get("degraded") for r in recommendations),
+    }
+
+
+def analyze_image_cached(image_bytes, block=False, deadline=None):
+    """analyze_image, answered from the result cache for images seen before.
+
+    The key is the SHA-256 of the uploaded bytes plus the knowledge version.
+    Identical uploads in flight at the same time share one computation, as
+    long as they agree on ``block``: a waiting job must not inherit the
+    CPUBusy of an /analyze request that was turned away. Degraded results
+    are returned but not cached, so a retry after a load peak gets the
+    full LLM text. A request waits for another request's computation only
+    as long as its own budget, then runs the pipeline itself (with no budget
+    left, its recommendations are the degraded template text).
+    """
+    deadline = deadline or Deadline()
+    if result_cache is None:
+        return analyze_image(image_bytes, block=block, deadline=deadline)
+
+    key = hash_key(hashlib.sha256(image_bytes).hexdigest(), index_knowledge(KNOWLEDGE_PATH).content_hash)
+    try:
+        return result_cache.get_or_compute(
+            key,
+            lambda: analyze_image(image_bytes, block=block, deadline=deadline),
+            cacheable=lambda result: not result.get("degraded"),
+            flight_key=(key, block),
+            timeout=deadline.remaining(),
+        )
+    except FlightTimeout:
+        print("[WARN] Budget ran out waiting for an identical upload's analysis")
+        return analyze_image(image_bytes, block=block, deadline=deadline)
+
+
+def ndjson(event):
+    return json.dumps(event, ensure_ascii=False) + "\n"
+
+
+def busy_response():
+    response = jsonify({"error": "Server is busy, retry later."})
+    response.headers["Retry-After"] = str(CPU_RETRY_AFTER)
+    return response, 503
+
+
+job_queue = JobQueue(
+    create_backend(JOB_BACKEND, path=JOB_DB_PATH, max_queued=JOB_QUEUE_SIZE, ttl=JOB_TTL),
+    # Background jobs wait for a CPU worker instead of failing when it is busy
+    partial(analyze_image_cached, block=True),
+    workers=JOB_WORKERS,
+)
+
+
+#  Startup
+# Nothing below may run at import time: CPU workers are spawned processes
+# that re-import this module as __mp_main__, and starting the pool (or
+# threads) there kills the worker before it is up.
+_started = False
+_start_lock = threading.Lock()
+
+
+def start_services():
+    """Warm the CPU pool, knowledge index and Ollama models and start the job workers.
+
+    Called once per serving process: from gunicorn's post_fork hook
+    (gunicorn.conf.py), from ``python app.py``, and otherwise on the first
+    request.
+    """
+    global _started
+    if _started:
+        return
+    with _start_lock:
+        if _started:
+            return
+        # Load the FaceLandmarker model(s) and the knowledge index once per worker instead of once per request
+        get_cpu_pool().warm_up()
+        index_knowledge(KNOWLEDGE_PATH)
+        # Load every generation model on every Ollama endpoint in the background so the first user skips the model load
+        for model in get_model_tiers().models:
+            warm_up_ollama(model)
+        job_queue.start()
+        _started = True
+
+
+@app.before_request
+def _ensure_started():
+    start_services()
+
+
 #  Routes 
 @app.route("/", methods=["GET"])
 def health():
     return jsonify({"status": "ok", "message": "GlamAi API is running by saroj "}), 200
 
 
+@app.route("/health/llm", methods=["GET"])
+def llm_health():
+    """Routing stats for each configured Ollama endpoint and generation model."""
+    endpoints = get_router().health()
+    status = 200 if any(e["healthy"] for e in endpoints) else 503
+    return jsonify({"endpoints": endpoints, "models": get_model_tiers().stats()}), status
+
+
 @app.route("/analyze", methods=["POST"])
 def analyze_face():
     """
@@ -47,59 +246,88 @@ def analyze_face():
       Layer 3  → classify features
       Generate → RAG + LLM makeup recommendations
     Returns JSON with face features and recommendations.
+    The whole request runs within REQUEST_BUDGET_SECONDS. Re-submitted
+    images are answered from the result cache.
     """
+    # The latency budget starts as soon as the request arrives
+    deadline = Deadline()
 
     #  Validate upload 
-    if "image" not in request.files:
-        return jsonify({"error": "No image file provided. Send as form-data with key 'image'."}), 400
+    image_bytes, error = read_upload()
+    if error:
+        return error
 
-    file = request.files["image"]
+    try:
+        return jsonify(analyze_image_cached(image_bytes, deadline=deadline)), 200
 
-    if file.filename == "":
-        return jsonify({"error": "Empty filename."}), 400
+    except CPUBusy:
+        return busy_response()
 
-    if not allowed_file(file.filename):
-        return jsonify({
-            "error": f"File type not allowed. Accepted: {', '.join(ALLOWED_EXTENSIONS)}"
-        }), 400
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 422
+
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": "An internal error occurred.", "details": str(e)}), 500
 
-    #  Save uploaded image 
-    unique_name = f"{uuid.uuid4().hex}_{secure_filename(file.filename)}"
-    image_path = os.path.join(app.config["UPLOAD_FOLDER"], unique_name)
-    file.save(image_path)
 
+@app.route("/analyze/faces", methods=["POST"])
+def analyze_group():
+    """
+    Multi-face variant of /analyze for group photos. One detector pass finds
+    up to ?max_faces=N faces (default and cap MAX_FACES); Layers 2–3 run
+    batched over all of them and faces with the same feature variants share
+    recommendations. Returns one result per face with a normalized bbox.
+    """
+    deadline = Deadline()
     try:
-        # 3. Layer 1 – Extract landmarks 
-        coords, img_shape = extract_landmarks(image_path, show_steps=False, save_steps=False)
-
-        #  Layer 2 – Calculate metrics 
-        metrics = calculate_metrics(coords, img_shape)
-
-        #  5. Layer 3 – Classify features 
-        face_features, human_text = classify_features(metrics)
-
-        # Save face features for generation step
-        features_path = os.path.join(app.config["UPLOAD_FOLDER"], f"{uuid.uuid4().hex}_features.json")
-        with open(features_path, "w", encoding="utf-8") as f:
-            json.dump(face_features, f, indent=4)
-
-        #  6. Generation – RAG + LLM recommendations 
-        recommendations = run_generation(
-            face_features_path=features_path,
-            knowledge_path="./knowledge",
-            output_path=os.path.join(app.config["UPLOAD_FOLDER"], f"{uuid.uuid4().hex}_recommendations.json"),
-            model_name="phi3"
+        max_faces = int(request.args.get("max_faces", MAX_FACES))
+    except ValueError:
+        return jsonify({"error": "max_faces must be an integer."}), 400
+    if max_faces < 1:
+        return jsonify({"error": "max_faces must be at least 1."}), 400
+
+    image_bytes, error = read_upload()
+    if error:
+        return error
+
+    try:
+        faces = analyze_faces(
+            image_bytes, knowledge_path=KNOWLEDGE_PATH,
+            max_faces=max_faces, landmark_indices=LANDMARK_SUBSET, deadline=deadline
         )
+        return jsonify({"success": True, "count": len(faces), "faces": faces}), 200
+
+    except CPUBusy:
+        return busy_response()
+
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 422
+
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": "An internal error occurred.", "details": str(e)}), 500
+
 
-        #  7. Build response 
-        response = {
-            "success": True,
-            "face_features": face_features,
-            "human_readable": human_text,
-            "recommendations": recommendations,
-        }
+@app.route("/analyze/debug", methods=["POST"])
+def analyze_face_debug():
+    """
+    Opt-in (DEBUG_ENDPOINT=1): runs Layer 1 only and returns the resized
+    image with the detected face mesh drawn on it, as image/png.
+    """
+    if not DEBUG_ENDPOINT:
+        return jsonify({"error": "Not found."}), 404
 
-        return jsonify(response), 200
+    image_bytes, error = read_upload()
+    if error:
+        return error
+
+    try:
+        png = get_cpu_pool().run(render_debug_task, image_bytes)
+        return Response(png, mimetype="image/png")
+
+    except CPUBusy:
+        return busy_response()
 
     except ValueError as ve:
         return jsonify({"error": str(ve)}), 422
@@ -108,13 +336,139 @@ def analyze_face():
         traceback.print_exc()
         return jsonify({"error": "An internal error occurred.", "details": str(e)}), 500
 
-    finally:
-        # Clean up uploaded image
-        if os.path.exists(image_path):
-            os.remove(image_path)
+
+@app.route("/analyze/stream", methods=["POST"])
+def analyze_face_stream():
+    """
+    Streaming variant of /analyze. Responds with NDJSON, one event per line:
+      {"event": "features", "face_features": ..., "human_readable": ...}
+      {"event": "retrieval", "features": [...]}
+      {"event": "token", ...}            only with ?tokens=1
+      {"event": "recommendation", "index": i, "recommendation": {...}}
+      {"event": "done"} or {"event": "error", "error": ...}
+    Layers 1–3 run before the response starts, so upload and face-detection
+    errors keep their usual 400/422 status codes.
+    """
+    deadline = Deadline()
+    image_bytes, error = read_upload()
+    if error:
+        return error
+
+    try:
+        face_features, human_text = classify_image(image_bytes)
+    except CPUBusy:
+        return busy_response()
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 422
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": "An internal error occurred.", "details": str(e)}), 500
+
+    stream_tokens = request.args.get("tokens", "").lower() in ("1", "true", "yes")
+
+    def events():
+        yield ndjson({"event": "features", "face_features": face_features, "human_readable": human_text})
+        try:
+            for event in iter_generation(
+                face_features,
+                knowledge_path=KNOWLEDGE_PATH,
+                stream_tokens=stream_tokens,
+                deadline=deadline
+            ):
+                yield ndjson(event)
+            yield ndjson({"event": "done"})
+        except Exception as e:
+            traceback.print_exc()
+            yield ndjson({"event": "error", "error": "An internal error occurred.", "details": str(e)})
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.route("/analyze/batch", methods=["POST"])
+def analyze_face_batch():
+    """
+    Accepts many images (form-data key 'images', repeated) and analyzes them
+    together. Returns {"success": true, "count": n, "results": [...]} with one
+    entry per image, in upload order; each entry is the /analyze body plus
+    "filename", or {"success": false, "error": ...} for images that failed.
+    """
+    deadline = Deadline()
+    request.max_content_length = BATCH_MAX_CONTENT_LENGTH
+    files = request.files.getlist("images")
+    if not files:
+        return jsonify({"error": "No images provided. Send as form-data with repeated key 'images'."}), 400
+    if len(files) > BATCH_MAX_IMAGES:
+        return jsonify({"error": f"Too many images. Maximum per batch is {BATCH_MAX_IMAGES}."}), 400
+
+    images, rejected = [], {}
+    for i, file in enumerate(files):
+        if not allowed_file(file.filename):
+            rejected[i] = f"File type not allowed. Accepted: {', '.join(ALLOWED_EXTENSIONS)}"
+            continue
+        data = file.read()
+        if not data:
+            rejected[i] = "Empty image file."
+            continue
+        images.append((i, data))
+
+    try:
+        analyzed = analyze_batch(
+            [data for _, data in images], knowledge_path=KNOWLEDGE_PATH,
+            landmark_indices=LANDMARK_SUBSET, deadline=deadline
+        )
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": "An internal error occurred.", "details": str(e)}), 500
+
+    results = [None] * len(files)
+    for i, error in rejected.items():
+        results[i] = {"success": False, "error": error}
+    for (i, _), result in zip(images, analyzed):
+        results[i] = result
+    for file, result in zip(files, results):
+        result["filename"] = file.filename
+
+    return jsonify({"success": True, "count": len(files), "results": results}), 200
+
+
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    """
+    Asynchronous /analyze: queues the image and returns a job id immediately.
+    Poll GET /jobs/<job_id> for the status and, once done, the same body
+    /analyze would have returned. Responds 503 with Retry-After when the
+    queue is full.
+    """
+    image_bytes, error = read_upload()
+    if error:
+        return error
+
+    try:
+        job_id = job_queue.submit(image_bytes)
+    except QueueFull:
+        response = jsonify({"error": "Too many queued jobs, retry later."})
+        response.headers["Retry-After"] = str(JOB_RETRY_AFTER)
+        return response, 503
+
+    return jsonify({"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found or expired."}), 404
+    return jsonify(job), 200
 
 
 #  Run 
 if __name__ == "__main__":
+    # The debug reloader's parent process only watches files; the child serves
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_services()
     port = int(os.getenv("PORT", 5000))
     app.run(host="0.0.0.0", port=port, debug=True)
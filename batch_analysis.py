@@ -0,0 +1,154 @@
+import os
+import numpy as np
+
+from cpu_pool import get_cpu_pool, extract_task, detect_faces_task
+from landmarker_pool import MAX_FACES
+from layer1_extraction import face_boxes
+from layer2_metrics import calculate_metrics_batch
+from layer3_classify import classify_features_batch
+from retrieve import index_knowledge, retrieve_from_face_features
+from generation import generate_all
+
+# Upper bound on images accepted by one /analyze/batch request
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", 100))
+
+
+def _extract_all(images, indices=None):
+    """Layer 1 for every image on the CPU pool → [(landmarks or None, error or None)]."""
+    extracted = []
+    for result in get_cpu_pool().map(extract_task, images, indices):
+        if isinstance(result, ValueError):
+            extracted.append((None, str(result)))
+        elif isinstance(result, Exception):
+            print(f"[WARN] Landmark extraction failed: {result}")
+            extracted.append((None, "An internal error occurred."))
+        else:
+            extracted.append((result, None))
+    return extracted
+
+
+def _classify_all(extracted):
+    """Layers 2–3 over every face that produced landmarks.
+
+    Metrics and rule evaluation for all faces run as vectorized passes. Returns
+    {position: (face_features, human_text)} and {position: error}.
+    """
+    classified, errors = {}, {}
+    if not extracted:
+        return classified, errors
+
+    positions = list(extracted)
+    landmarks = np.stack([landmarks for landmarks, _ in extracted.values()])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        batch = calculate_metrics_batch(landmarks)
+    valid = np.logical_and.reduce([np.isfinite(values) for values in batch.values()])
+
+    rows = np.flatnonzero(valid)
+    results = classify_features_batch({name: values[rows] for name, values in batch.items()})
+    classified.update((positions[row], result) for row, result in zip(rows, results))
+    for row in np.flatnonzero(~valid):
+        errors[positions[row]] = "Could not measure facial features."
+    return classified, errors
+
+
+def _generation_key(feature_data):
+    return (
+        feature_data.get("feature"),
+        feature_data.get("variant"),
+        feature_data.get("technique"),
+        tuple(feature_data.get("steps", [])),
+    )
+
+
+def _recommend(classified, knowledge_path, model_name, deadline=None):
+    """Retrieval + generation for {key: (face_features, human_text)}.
+
+    Each distinct recommendation is generated once, however many faces
+    share it. Returns {key: [recommendation, ...]}.
+    """
+    index_knowledge(knowledge_path)
+    retrieved = {key: retrieve_from_face_features(features, top_k=1) for key, (features, _) in classified.items()}
+
+    unique = {}
+    for results in retrieved.values():
+        for feature_data in results:
+            unique.setdefault(_generation_key(feature_data), feature_data)
+    print(f"[INFO] {len(classified)} faces -> {len(unique)} distinct recommendations")
+
+    generated = dict(zip(unique, generate_all(list(unique.values()), model_name=model_name, deadline=deadline)))
+    return {key: [generated[_generation_key(f)] for f in results] for key, results in retrieved.items()}
+
+
+def analyze_batch(images, knowledge_path="./knowledge", model_name=None, landmark_indices=None,
+                  deadline=None):
+    """Run the full pipeline over many images at once.
+
+    Decoding and landmark extraction run in parallel on the CPU pool
+    (waiting for free workers rather than failing), Layers 2–3 run
+    vectorized over all faces, and retrieval +
+    generation are deduplicated across images that share feature variants,
+    so each distinct recommendation is generated once per batch.
+
+    Returns one entry per input image, in order. A failing image yields
+    ``{"success": False, "error": ...}`` without failing the batch.
+    ``landmark_indices`` enables Layer 1's sparse mode; every LLM call
+    shares ``deadline``.
+    """
+    extracted = _extract_all(images, landmark_indices)
+
+    errors = {i: error for i, (landmarks, error) in enumerate(extracted) if landmarks is None}
+    classified, classify_errors = _classify_all(
+        {i: landmarks for i, (landmarks, _) in enumerate(extracted) if landmarks is not None}
+    )
+    errors.update(classify_errors)
+
+    recommendations = _recommend(classified, knowledge_path, model_name, deadline)
+    print(f"[INFO] Batch of {len(images)}: {len(classified)} faces")
+
+    output = []
+    for i in range(len(images)):
+        if i not in classified:
+            output.append({"success": False, "error": errors[i]})
+            continue
+        face_features, human_text = classified[i]
+        output.append({
+            "success": True,
+            "face_features": face_features,
+            "human_readable": human_text,
+            "recommendations": recommendations[i],
+        })
+    return output
+
+
+def analyze_faces(image, knowledge_path="./knowledge", model_name=None, max_faces=MAX_FACES,
+                  landmark_indices=None, block=False, deadline=None):
+    """Analyze every face in one image (up to ``max_faces``) with a single detector pass.
+
+    Layers 2–3 run batched over all faces and faces sharing feature variants
+    share their recommendations. Returns one entry per detected face with its
+    normalized ``bbox``; raises ValueError when no face is found and
+    CPUBusy when the CPU pool is saturated (unless ``block``).
+    """
+    landmarks, img_shape = get_cpu_pool().run(
+        detect_faces_task, image, max(1, min(max_faces, MAX_FACES)), landmark_indices, block=block
+    )
+    boxes = face_boxes(landmarks)
+
+    classified, errors = _classify_all({i: (face, img_shape) for i, face in enumerate(landmarks)})
+    recommendations = _recommend(classified, knowledge_path, model_name, deadline)
+
+    output = []
+    for i, bbox in enumerate(boxes):
+        if i not in classified:
+            output.append({"face": i, "bbox": bbox, "success": False, "error": errors[i]})
+            continue
+        face_features, human_text = classified[i]
+        output.append({
+            "face": i,
+            "bbox": bbox,
+            "success": True,
+            "face_features": face_features,
+            "human_readable": human_text,
+            "recommendations": recommendations[i],
+        })
+    return output
@@ -0,0 +1,329 @@
+import os
+import json
+import time
+import queue
+import socket
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+
+def hash_key(*parts):
+    """Stable SHA-256 key over string parts (e.g. model name + prompt)."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class LRUCache:
+    """Thread-safe in-process LRU with an optional per-entry TTL (seconds)."""
+
+    def __init__(self, max_entries=512, ttl=None):
+        self._max_entries = max(1, max_entries)
+        self._ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self._ttl if self._ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self._max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class DiskCache:
+    """JSON-on-disk cache with a TTL and a total size budget.
+
+    One file per key; when the directory grows past ``max_bytes`` the least
+    recently used files (by mtime, refreshed on every hit) are evicted.
+    """
+
+    def __init__(self, directory, ttl=None, max_bytes=64 * 1024 * 1024):
+        self._dir = directory
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self._dir, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("expires") is not None and entry["expires"] < time.time():
+            self.delete(key)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry.get("value")
+
+    def set(self, key, value):
+        expires = time.time() + self._ttl if self._ttl else None
+        path = self._path(key)
+        # Workers forked from one master can share thread idents, so the pid is part of the name
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"expires": expires, "value": value}, f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[WARN] Disk cache write failed: {e}")
+            return
+        self._evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self._dir):
+                if not name.endswith(".json"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self._dir, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+                total += stat.st_size
+            entries.sort()
+            for _, size, name in entries:
+                if total <= self._max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self._dir, name))
+                except OSError:
+                    pass
+                total -= size
+
+
+class RedisCache:
+    """JSON values in any Redis-protocol server (Redis, Valkey, KeyDB, ...).
+
+    Speaks RESP over a small pool of sockets, so no client library is needed.
+    Keys are namespaced with ``prefix`` and expire after ``ttl`` seconds.
+    When the server can't be reached the cache reads as empty and writes are
+    dropped; it is retried after ``retry_after`` seconds.
+    """
+
+    def __init__(self, url="redis://localhost:6379/0", ttl=None, prefix="glamai:", timeout=1.0, retry_after=5.0):
+        parsed = urlparse(url)
+        self._address = (parsed.hostname or "localhost", parsed.port or 6379)
+        self._password = parsed.password
+        self._db = int(parsed.path.strip("/") or 0)
+        self._ttl = ttl
+        self._prefix = prefix
+        self._timeout = timeout
+        self._retry_after = retry_after
+        self._down_until = 0.0
+        self._idle = queue.LifoQueue()
+
+    def _connect(self):
+        sock = socket.create_connection(self._address, timeout=self._timeout)
+        conn = (sock, sock.makefile("rb"))
+        if self._password:
+            self._roundtrip(conn, "AUTH", self._password)
+        if self._db:
+            self._roundtrip(conn, "SELECT", self._db)
+        return conn
+
+    @staticmethod
+    def _roundtrip(conn, *args):
+        sock, reader = conn
+        parts = [str(arg).encode("utf-8") if not isinstance(arg, bytes) else arg for arg in args]
+        payload = b"*%d\r\n" % len(parts) + b"".join(b"$%d\r\n%s\r\n" % (len(p), p) for p in parts)
+        sock.sendall(payload)
+
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("connection closed by server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"-":
+            raise RuntimeError(rest.decode("utf-8", "replace"))
+        if kind == b"$":
+            length = int(rest)
+            return None if length < 0 else reader.read(length + 2)[:-2]
+        return rest
+
+    def _command(self, *args):
+        if time.monotonic() < self._down_until:
+            return None
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+        try:
+            conn = conn or self._connect()
+            reply = self._roundtrip(conn, *args)
+        except (OSError, ValueError, RuntimeError) as e:
+            if conn is not None:
+                conn[0].close()
+            self._down_until = time.monotonic() + self._retry_after
+            print(f"[WARN] Redis cache {self._address[0]}:{self._address[1]} unavailable: {e}")
+            return None
+        self._idle.put(conn)
+        return reply
+
+    def get(self, key):
+        raw = self._command("GET", self._prefix + key)
+        if raw is None:
+            return None
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return None
+
+    def set(self, key, value):
+        args = ["SET", self._prefix + key, json.dumps(value, ensure_ascii=False)]
+        if self._ttl:
+            args += ["PX", int(self._ttl * 1000)]
+        self._command(*args)
+
+    def delete(self, key):
+        self._command("DEL", self._prefix + key)
+
+
+class FlightTimeout(TimeoutError):
+    """Raised to a SingleFlight follower whose wait for the leader timed out."""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into one execution."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, timeout=None):
+        """Run ``fn()`` or join the call already running for ``key``.
+
+        Followers wait at most ``timeout`` seconds (None: until the leader
+        finishes) and then raise FlightTimeout; the leader carries on.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if not call.done.wait(timeout):
+                raise FlightTimeout(f"gave up waiting for in-flight call after {timeout:.1f}s")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class TieredCache:
+    """Memory tier in front of an optional slower tier, with single-flight misses."""
+
+    def __init__(self, memory, backing=None):
+        self._memory = memory
+        self._backing = backing
+        self._flight = SingleFlight()
+
+    def get(self, key):
+        value = self._memory.get(key)
+        if value is None and self._backing is not None:
+            value = self._backing.get(key)
+            if value is not None:
+                self._memory.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self._memory.set(key, value)
+        if self._backing is not None:
+            self._backing.set(key, value)
+
+    def get_or_compute(self, key, compute, cacheable=None, flight_key=None, timeout=None):
+        """Return the cached value for ``key`` or compute it exactly once.
+
+        Concurrent callers with the same key wait on the single in-flight
+        ``compute()``. A ``None`` result, or one ``cacheable(result)``
+        rejects, is returned but not cached. ``flight_key`` (default
+        ``key``) narrows which callers share a computation, for callers
+        that must not inherit each other's failures. A caller joining another
+        caller's computation raises FlightTimeout after ``timeout`` seconds.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        def _leader():
+            cached = self.get(key)
+            if cached is not None:
+                return cached
+            result = compute()
+            if result is not None and (cacheable is None or cacheable(result)):
+                self.set(key, result)
+            return result
+
+        return self._flight.do(key if flight_key is None else flight_key, _leader, timeout=timeout)
+
+
+def create_cache(kind="memory", max_entries=512, ttl=None, directory="./cache",
+                 max_bytes=64 * 1024 * 1024, url="redis://localhost:6379/0", prefix="glamai:"):
+    """TieredCache with an in-process LRU in front of the ``kind`` backend.
+
+    "memory" is per process; "disk" and "redis" are shared by every worker
+    (and, for redis, every replica), with the LRU still answering hot keys
+    locally if the shared store is slow or down.
+    """
+    memory = LRUCache(max_entries, ttl=ttl)
+    if kind == "memory":
+        return TieredCache(memory)
+    if kind == "disk":
+        return TieredCache(memory, DiskCache(directory, ttl=ttl, max_bytes=max_bytes))
+    if kind == "redis":
+        return TieredCache(memory, RedisCache(url, ttl=ttl, prefix=prefix))
+    raise ValueError(f"Unknown cache backend: {kind}")
@@ -0,0 +1,162 @@
+import os
+import atexit
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import landmarker_pool
+from layer1_extraction import extract_landmarks, detect_faces, detect_landmarks
+from layer2_metrics import calculate_metrics
+from layer3_classify import classify_features
+
+# CPU-bound stages (decode, MediaPipe, Layers 2–3) run in worker processes
+# so they don't compete for the GIL with request and LLM threads.
+# 0 runs them inline in the calling thread.
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", 0))
+# Tasks allowed to wait for a free worker before callers are turned away
+CPU_QUEUE_SIZE = int(os.getenv("CPU_QUEUE_SIZE", 4))
+CPU_RETRY_AFTER = int(os.getenv("CPU_RETRY_AFTER", 2))
+
+
+class CPUBusy(Exception):
+    """Raised by CPUPool.run when every worker is busy and the queue is full."""
+
+
+# ---------------------------
+# Worker-side tasks (module level so they can be pickled)
+# ---------------------------
+def _init_worker():
+    # A worker runs one task at a time, so one warm landmarker is enough
+    landmarker_pool.POOL_SIZE = 1
+    landmarker_pool.warm_up_landmarkers()
+
+
+def _ping():
+    return os.getpid()
+
+
+def classify_task(image_bytes, indices=None):
+    """Layers 1–3 for one image → (face_features, human_text)."""
+    landmarks, img_shape = extract_landmarks(image_bytes, show_steps=False, save_steps=False, indices=indices)
+    metrics = calculate_metrics(landmarks, img_shape)
+    return classify_features(metrics)
+
+
+def extract_task(image_bytes, indices=None):
+    """Layer 1 for one image → (landmarks, resized_shape)."""
+    return extract_landmarks(image_bytes, show_steps=False, save_steps=False, indices=indices)
+
+
+def detect_faces_task(image_bytes, num_faces, indices=None):
+    """Layer 1 for every face in one image → (landmarks (F, 478, 3), resized_shape)."""
+    landmarks, resized = detect_faces(image_bytes, num_faces=num_faces, indices=indices)
+    return landmarks, resized.shape
+
+
+def render_debug_task(image_bytes):
+    """Layer 1 + mesh rendering → PNG bytes."""
+    from visualization import render_png
+    landmarks, resized = detect_landmarks(image_bytes)
+    return render_png(resized, landmarks)
+
+
+# ---------------------------
+# Pool
+# ---------------------------
+class CPUPool:
+    """Process pool with a bounded number of in-flight tasks.
+
+    At most ``workers + queue_size`` tasks are running or waiting at once.
+    ``run(..., block=False)`` raises CPUBusy beyond that instead of queueing;
+    ``block=True`` waits for a slot (used by batches and background jobs).
+    Each worker process keeps its own warm FaceLandmarker.
+    """
+
+    def __init__(self, workers=CPU_WORKERS, queue_size=CPU_QUEUE_SIZE):
+        self._workers = workers
+        self._slots = threading.BoundedSemaphore(max(1, workers) + max(0, queue_size))
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: forking a process that already runs threads (and MediaPipe) is unsafe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self._workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                )
+            return self._executor
+
+    def _reset(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def warm_up(self):
+        """Start every worker process (and its landmarker) ahead of traffic."""
+        if self._workers <= 0:
+            landmarker_pool.warm_up_landmarkers()
+            return
+        print(f"[INFO] Starting {self._workers} CPU worker process(es)...")
+        executor = self._get_executor()
+        for future in [executor.submit(_ping) for _ in range(self._workers)]:
+            future.result()
+
+    def run(self, fn, *args, block=False, timeout=None):
+        """Run ``fn(*args)`` on a worker and return its result."""
+        if not self._slots.acquire(blocking=block, timeout=timeout if block else None):
+            raise CPUBusy("CPU workers are busy")
+        try:
+            if self._workers <= 0:
+                return fn(*args)
+            executor = self._get_executor()
+            try:
+                return executor.submit(fn, *args).result()
+            except BrokenProcessPool:
+                # A worker died (e.g. crashed inside native code); start a fresh pool next time
+                print("[WARN] CPU worker pool broken, restarting")
+                self._reset(executor)
+                raise
+        finally:
+            self._slots.release()
+
+    def map(self, fn, items, *args):
+        """``[fn(item, *args) for item in items]`` across the workers, waiting for slots.
+
+        Exceptions are returned in place of results so one bad item does not
+        fail the others.
+        """
+        def _one(item):
+            try:
+                return self.run(fn, item, *args, block=True)
+            except Exception as e:
+                return e
+
+        threads = self._workers if self._workers > 0 else landmarker_pool.POOL_SIZE
+        with ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="cpu-submit") as pool:
+            return list(pool.map(_one, items))
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_cpu_pool():
+    """Return the process-wide CPU pool, creating it on first call."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = CPUPool()
+                atexit.register(_pool.close)
+    return _pool
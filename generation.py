@@ -1,36 +1,192 @@
+import os
 import json
 import re
-import ollama
-from retrieve import retrieve_from_face_features, load_face_features, index_knowledge
+import time
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from cache import DiskCache, FlightTimeout, LRUCache, TieredCache, hash_key
+from ollama_client import get_router
+from model_tiers import TEMPLATE_MODEL, get_model_tiers
+from retrieve import retrieve_from_face_features, load_face_features, index_knowledge, normalize
+
+# Per-request cap on concurrent Ollama calls in run_generation
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", 4))
+
+# "per_feature" (one Ollama call per feature) or "batched" (one call for all)
+GENERATION_MODE = os.getenv("GENERATION_MODE", "per_feature")
+
+# ---------------------------
+# Structured output
+# ---------------------------
+# Constrain Ollama to the response schema, cap the answer length and stop
+# reading the stream as soon as the JSON value closes. Set
+# LLM_STRUCTURED_OUTPUT=0 for free-text generation parsed by extract_json.
+LLM_STRUCTURED_OUTPUT = os.getenv("LLM_STRUCTURED_OUTPUT", "1") == "1"
+# Generated-token cap per feature (batched prompts get one per feature)
+LLM_NUM_PREDICT = int(os.getenv("LLM_NUM_PREDICT", 200))
+# Constrained JSON can't contain these, but models may pad it with blank lines
+LLM_STOP_SEQUENCES = ["```", "\n\n\n"]
+
+RECOMMENDATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "why_it_matches": {"type": "string"},
+        "awareness": {"type": "string"},
+    },
+    "required": ["why_it_matches", "awareness"],
+}
+BATCH_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "id": {"type": "integer"},
+            "why_it_matches": {"type": "string"},
+            "awareness": {"type": "string"},
+        },
+        "required": ["id", "why_it_matches", "awareness"],
+    },
+}
+
+
+class JSONEndScanner:
+    """Finds where the first top-level JSON object/array closes in streamed text."""
+
+    def __init__(self):
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text):
+        """Return the offset just past the closing bracket in ``text``, or None."""
+        for i, ch in enumerate(text):
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]" and self._depth:
+                self._depth -= 1
+                if self._depth == 0:
+                    return i + 1
+        return None
+
+
+# ---------------------------
+# Latency budget
+# ---------------------------
+# Wall-clock budget for one request, started when the request arrives and
+# shared by every LLM call it makes. Calls are skipped once less than
+# LLM_MIN_CALL_SECONDS remain; those features get the template text and are
+# marked "degraded".
+REQUEST_BUDGET_SECONDS = float(os.getenv("REQUEST_BUDGET_SECONDS", 120))
+LLM_MIN_CALL_SECONDS = float(os.getenv("LLM_MIN_CALL_SECONDS", 3))
+
+
+class Deadline:
+    """Absolute deadline for a request; ``seconds=None`` means unbounded."""
+
+    def __init__(self, seconds=REQUEST_BUDGET_SECONDS):
+        self._expires = time.monotonic() + seconds if seconds else None
+
+    def remaining(self):
+        if self._expires is None:
+            return None
+        return max(0.0, self._expires - time.monotonic())
+
+    def expired(self):
+        return self.remaining() == 0.0
+
+    def allows(self, seconds):
+        remaining = self.remaining()
+        return remaining is None or remaining >= seconds
+
+
+def _timeout(deadline):
+    """Per-call timeout: the remaining budget, or None for the client default."""
+    return deadline.remaining() if deadline else None
+
+
+# ---------------------------
+# LLM response cache
+# ---------------------------
+# Prompts depend only on feature, variant, technique and steps, so identical
+# features across users map to the same Ollama call. Successful generations
+# are cached per (model, prompt) in memory and on disk; set LLM_CACHE_DIR=""
+# to keep the cache in memory only.
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "./llm_cache")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", 512))
+
+llm_cache = TieredCache(
+    LRUCache(LLM_CACHE_SIZE, ttl=LLM_CACHE_TTL),
+    DiskCache(LLM_CACHE_DIR, ttl=LLM_CACHE_TTL, max_bytes=LLM_CACHE_MAX_BYTES) if LLM_CACHE_DIR else None,
+)
 
 
 # ---------------------------
 # JSON extractor (SAFE)
 # ---------------------------
-def extract_json(raw_text):
+# Placeholders extract_json puts in fields the model left empty
+NO_EXPLANATION = "LLM failed to generate explanation"
+NO_AWARENESS = "No awareness tip"
+
+
+def _is_usable(answer):
+    """True when the model produced real text for both fields."""
+    why = answer.get("why_it_matches") or ""
+    awareness = answer.get("awareness") or ""
+    return bool(why) and bool(awareness) and NO_EXPLANATION not in why and NO_AWARENESS not in awareness
+
+
+def _repair_json(text):
+    """Best-effort parse of free-text LLM JSON; None if it can't be repaired."""
+    text = text.replace("’", "'").replace("“", '"').replace("”", '"')
+    text = re.sub(r"[\x00-\x1f\x7f]", "", text)
+    text = re.sub(r"(\w+):", r'"\1":', text)
+
+    try:
+        return json.loads(text)
+    except Exception:
+        try:
+            return json.loads(text.replace("'", '"'))
+        except Exception:
+            return None
+
+
+def extract_json(raw_text, keyed_by=None):
     """
     Robust JSON extractor for LLM outputs.
     Returns a dict with:
         - why_it_matches: always string
         - awareness: always string
+
+    With ``keyed_by`` (e.g. "id") the output is expected to hold one
+    object per item, and a dict {normalized key: {why_it_matches, awareness}}
+    is returned instead, containing only the items that produced any text.
     """
     if not raw_text:
-        return {"why_it_matches": "", "awareness": ""}
+        return {} if keyed_by else {"why_it_matches": "", "awareness": ""}
 
     # Remove code fences and unwanted chars
     text = re.sub(r"```json|```", "", raw_text, flags=re.IGNORECASE).strip()
-    text = text.replace("’", "'").replace("“", '"').replace("”", '"')
-    text = re.sub(r"[\x00-\x1f\x7f]", "", text)
-    text = re.sub(r"(\w+):", r'"\1":', text)
 
+    # Well-formed output (structured mode) needs no repairs, which could
+    # otherwise mangle text such as "Tip: blend" inside string values
     try:
         parsed = json.loads(text)
     except Exception:
-        try:
-            parsed = json.loads(text.replace("'", '"'))
-        except Exception:
-            print(f"Warning: JSON parse failed. Returning empty.\nRaw output: {raw_text}")
-            return {"why_it_matches": "", "awareness": ""}
+        parsed = _repair_json(text)
+    if parsed is None:
+        print(f"Warning: JSON parse failed. Returning empty.\nRaw output: {raw_text}")
+        return {} if keyed_by else {"why_it_matches": "", "awareness": ""}
 
     # Flatten keys
     why_keys = ["why_it_matches", "whyItMatches", "whyItMatchesReasoning"]
@@ -56,6 +212,22 @@ def extract_json(raw_text):
                 break
         return w.strip(), a.strip()
 
+    if keyed_by:
+        items = parsed
+        if isinstance(parsed, dict):
+            # Accept {"recommendations": [...]} as well as {"eyes": {...}, ...}
+            lists = [v for v in parsed.values() if isinstance(v, list)]
+            items = lists[0] if lists else [
+                {**v, keyed_by: k} for k, v in parsed.items() if isinstance(v, dict)
+            ]
+        keyed = {}
+        for item in items if isinstance(items, list) else []:
+            if isinstance(item, dict) and item.get(keyed_by):
+                w, a = extract_fields(item)
+                if w and a:
+                    keyed[normalize(str(item[keyed_by]))] = {"why_it_matches": w, "awareness": a}
+        return keyed
+
     if isinstance(parsed, dict):
         w, a = extract_fields(parsed)
         if w: combined_why.append(w)
@@ -76,8 +248,8 @@ def extract_json(raw_text):
                 if a: combined_awareness.append(a)
 
     return {
-        "why_it_matches": " ".join(combined_why).strip() or "LLM failed to generate explanation",
-        "awareness": " ".join(combined_awareness).strip() or "No awareness tip"
+        "why_it_matches": " ".join(combined_why).strip() or NO_EXPLANATION,
+        "awareness": " ".join(combined_awareness).strip() or NO_AWARENESS
     }
 
 # ---------------------------
@@ -118,38 +290,148 @@ Return ONLY valid JSON in this EXACT structure:
     return prompt
 
 
+def build_batch_prompt(features):
+    """One prompt covering every feature, so the shared rules are sent once.
+
+    Items are numbered from 1 and answers carry that number as ``id``, since
+    one batch can hold several variants of the same feature.
+    """
+    sections = []
+    for n, feature_data in enumerate(features, 1):
+        steps_text = json.dumps(feature_data.get("steps", []), ensure_ascii=False)
+        sections.append(
+            f"{n}. Feature: {feature_data['feature']}\n"
+            f"   Variant: {feature_data['variant']}\n"
+            f"   Technique: {feature_data.get('technique') or 'No specific technique provided'}\n"
+            f"   Provided steps (DO NOT CHANGE): {steps_text}"
+        )
+    features_text = "\n\n".join(sections)
+
+    prompt = f"""
+You are a professional makeup educator.
+
+STRICT RULES:
+- You MUST NOT create, modify, reorder, or rephrase steps
+- Steps are PROVIDED and MUST remain EXACTLY the same
+- You are ONLY allowed to:
+  1. Explain why each technique suits its feature
+  2. Add awareness or caution notes
+
+Features:
+{features_text}
+
+Return ONLY a valid JSON array with one object per numbered item, in this EXACT structure:
+[
+  {{
+    "id": item number as given,
+    "why_it_matches": "clear, concise explanation",
+    "awareness": "simple precaution or tip"
+  }}
+]
+"""
+    return prompt
+
+
 # ---------------------------
 # Generate recommendation
 # ---------------------------
-def generate_recommendation(feature_data, model_name="phi3", max_retries=3):
-    """
-    Generates why_it_matches and awareness for a feature.
-    Ensures frontend-safe strings and provides fallbacks if LLM fails.
-    """
-    feature_name = feature_data.get("feature", "unknown")
-    if not feature_data.get("steps"):
-        return {"why_it_matches": "No steps available", "awareness": ""}
+def _structured_kwargs(schema, num_predict):
+    return {"format": schema, "options": {"num_predict": num_predict, "stop": LLM_STOP_SEQUENCES}}
 
-    prompt = build_prompt(feature_data)
 
-    parsed = {}
+def _stream_chat(prompt, model_name, on_token=None, deadline=None, schema=None, num_predict=None):
+    """Stream an Ollama chat, forwarding each token; returns (content, last chunk).
+
+    With ``schema`` the output is constrained to it and reading stops (closing
+    the stream, which ends generation on the host) as soon as the top-level
+    JSON value is complete.
+    """
+    parts = []
+    chunk = {}
+    kwargs = _structured_kwargs(schema, num_predict) if schema else {}
+    scanner = JSONEndScanner() if schema else None
+    stream = get_router().chat(
+        model=model_name,
+        messages=[{"role": "user", "content": prompt}],
+        stream=True,
+        timeout=_timeout(deadline),
+        **kwargs
+    )
+    try:
+        for chunk in stream:
+            # The client timeout only bounds the gap between chunks
+            if deadline and deadline.expired():
+                raise TimeoutError("request budget exhausted mid-stream")
+            token = chunk["message"]["content"]
+            if not token:
+                continue
+            end = scanner.feed(token) if scanner else None
+            if end is not None:
+                token = token[:end]
+            parts.append(token)
+            if on_token:
+                on_token(token)
+            if end is not None:
+                break
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+    return "".join(parts), chunk
+
+
+def _chat_with_retries(prompt, model_name, max_retries, label, keyed_by=None, on_token=None, deadline=None,
+                       schema=None, num_predict=None):
+    """Call Ollama until it returns usable JSON; None if every attempt failed.
+
+    With ``on_token`` the reply is streamed and every token is passed to it
+    as it arrives (tokens from a failed attempt are followed by the retry's).
+    With a ``deadline`` each call times out with the remaining budget and no
+    call is started once less than LLM_MIN_CALL_SECONDS remain. With
+    ``schema`` (structured mode) the reply is constrained to it, capped at
+    ``num_predict`` tokens and always streamed so it can stop early.
+    """
     for attempt in range(max_retries):
+        if deadline and not deadline.allows(LLM_MIN_CALL_SECONDS):
+            print(f"[WARN] {label}: skipping LLM call, {deadline.remaining():.1f}s of budget left")
+            return None
         try:
-            response = ollama.chat(
-                model=model_name,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            content = response["message"]["content"]
-            parsed = extract_json(content)
-
-            if parsed.get("why_it_matches") or parsed.get("awareness"):
-                break  # Successfully generated
+            # Every call feeds the latency/queue stats the model tiers route on
+            with get_model_tiers().track(model_name, deadline):
+                if on_token or schema:
+                    content, response = _stream_chat(prompt, model_name, on_token, deadline, schema, num_predict)
+                else:
+                    response = get_router().chat(
+                        model=model_name,
+                        messages=[{"role": "user", "content": prompt}],
+                        timeout=_timeout(deadline)
+                    )
+                    content = response["message"]["content"]
+            if response.get("done"):
+                print(
+                    f"[INFO] {label}: {response.get('prompt_eval_count')} prompt tokens, "
+                    f"{response.get('eval_count')} generated tokens"
+                )
+            else:
+                print(f"[INFO] {label}: stopped reading after {len(content)} characters of JSON")
+            parsed = extract_json(content, keyed_by=keyed_by)
+
+            if keyed_by and parsed:
+                return parsed
+            if not keyed_by and _is_usable(parsed):
+                return parsed  # Successfully generated
+            # Empty or placeholder text is a failed attempt, so it is retried
+            # and never cached
+            print(f"Attempt {attempt+1} for {label}: no usable text in the reply")
 
         except Exception as e:
-            print(f"Attempt {attempt+1} failed for {feature_name}: {e}")
+            print(f"Attempt {attempt+1} failed for {label}: {e}")
+    return None
 
-    # --- FALLBACKS if LLM failed ---
-    if not parsed.get("why_it_matches") or "LLM failed" in parsed.get("why_it_matches"):
+
+def _apply_fallbacks(parsed, feature_data):
+    """Fill in template text for anything the LLM failed to produce."""
+    if not parsed.get("why_it_matches") or NO_EXPLANATION in parsed.get("why_it_matches"):
         feature = feature_data.get("feature", "feature")
         variant = feature_data.get("variant", "")
         technique = feature_data.get("technique", "")
@@ -158,7 +440,7 @@ def generate_recommendation(feature_data, model_name="phi3", max_retries=3):
             "by enhancing natural features and maintaining balance."
             )
 
-    if not parsed.get("awareness") or "No awareness tip" in parsed.get("awareness"):
+    if not parsed.get("awareness") or NO_AWARENESS in parsed.get("awareness"):
         parsed["awareness"] = (
         "Apply products gently and blend well to maintain a natural look."
         )
@@ -168,38 +450,176 @@ def generate_recommendation(feature_data, model_name="phi3", max_retries=3):
 
     return parsed
 
+
+def _structured(schema, n_features):
+    """Structured-mode arguments for _chat_with_retries (none when disabled)."""
+    if not LLM_STRUCTURED_OUTPUT:
+        return {}
+    return {"schema": schema, "num_predict": LLM_NUM_PREDICT * n_features}
+
+
+def _choose_model(prompt, deadline):
+    """Model for ``prompt`` from the tiers → (model, cached answer or None).
+
+    A cached answer is reused only from the chosen model or one ranked above
+    it, so a fallback model's answers from a load peak don't outlive the
+    peak. With every model out of rotation any cached answer beats the
+    template text.
+    """
+    tiers = get_model_tiers()
+    chosen = tiers.choose(deadline)
+    ranked = tiers.models
+    for model in ranked[:ranked.index(chosen) + 1] if chosen in ranked else ranked:
+        cached = llm_cache.get(hash_key(model, prompt))
+        if cached:
+            return model, cached
+    return chosen, None
+
+
+def generate_recommendation(feature_data, model_name=None, max_retries=3, on_token=None, deadline=None):
+    """
+    Generates why_it_matches and awareness for a feature.
+    Ensures frontend-safe strings and provides fallbacks if LLM fails.
+    ``on_token`` receives raw tokens when the answer is not already cached.
+    The result has ``degraded=True`` when the template text stands in for an
+    LLM answer that failed or did not fit in the ``deadline``.
+
+    Without ``model_name`` the model tiers pick one (reusing a cached answer
+    from that tier or a better one); ``model`` in the result names the model that
+    answered, or "template".
+    """
+    feature_name = feature_data.get("feature", "unknown")
+    if not feature_data.get("steps"):
+        return {"why_it_matches": "No steps available", "awareness": "", "model": None}
+
+    prompt = build_prompt(feature_data)
+
+    cached = None
+    if model_name is None:
+        model_name, cached = _choose_model(prompt, deadline)
+    if not cached and model_name != TEMPLATE_MODEL:
+        # Concurrent requests for the same prompt share one in-flight generation,
+        # waiting for another request's call only as long as our own budget
+        try:
+            cached = llm_cache.get_or_compute(
+                hash_key(model_name, prompt),
+                lambda: _chat_with_retries(prompt, model_name, max_retries, feature_name, on_token=on_token,
+                                           deadline=deadline, **_structured(RECOMMENDATION_SCHEMA, 1)),
+                timeout=_timeout(deadline)
+            )
+        except FlightTimeout:
+            print(f"[WARN] {feature_name}: budget ran out waiting for a shared LLM call")
+    parsed = dict(cached) if cached else {}
+
+    # --- FALLBACKS if LLM failed ---
+    generated = _apply_fallbacks(parsed, feature_data)
+    generated["degraded"] = not cached
+    generated["model"] = model_name if cached else TEMPLATE_MODEL
+    return generated
+
+
+def generate_batched(retrieval_results, model_name=None, max_retries=3, deadline=None):
+    """Generate text for every feature with a single Ollama call.
+
+    Returns {index in ``retrieval_results``: {why_it_matches, awareness, model}}
+    for the features the model answered; callers fall back to the
+    per-feature path for the rest. Without ``model_name`` the model tiers
+    pick one.
+    """
+    positions = [i for i, f in enumerate(retrieval_results) if f.get("steps")]
+    features = [retrieval_results[i] for i in positions]
+    if not features:
+        return {}
+
+    prompt = build_batch_prompt(features)
+    cached = None
+    if model_name is None:
+        model_name, cached = _choose_model(prompt, deadline)
+    if not cached and model_name != TEMPLATE_MODEL:
+        try:
+            cached = llm_cache.get_or_compute(
+                hash_key(model_name, prompt),
+                lambda: _chat_with_retries(prompt, model_name, max_retries, "batch", keyed_by="id",
+                                           deadline=deadline, **_structured(BATCH_SCHEMA, len(features))),
+                timeout=_timeout(deadline)
+            )
+        except FlightTimeout:
+            print("[WARN] batch: budget ran out waiting for a shared LLM call")
+    # Answers are keyed by the 1-based item number from the prompt
+    by_position = {}
+    for item_id, answer in (cached or {}).items():
+        if item_id.isdigit() and 1 <= int(item_id) <= len(positions):
+            by_position[positions[int(item_id) - 1]] = {**answer, "model": model_name}
+    return by_position
+
+def _build_recommendation(feature_data, generated):
+    return {
+        "feature": feature_data.get("feature", "unknown"),
+        "variant": feature_data.get("variant", ""),
+        "technique": feature_data.get("technique", ""),
+        "steps": feature_data.get("steps", []),
+        "why_it_matches": generated.get("why_it_matches", ""),
+        "awareness": generated.get("awareness", ""),
+        "degraded": generated.get("degraded", False),
+        "model": generated.get("model")
+    }
+
+
+def generate_all(retrieval_results, model_name=None, max_concurrency=None, mode=None, deadline=None):
+    """Generate recommendations for every retrieved feature.
+
+    In "per_feature" mode each feature is an independent, blocking Ollama
+    round trip, so they run on a thread pool capped at ``max_concurrency``
+    (GENERATION_CONCURRENCY by default). In "batched" mode all features share
+    one prompt and only the features missing from its answer take the
+    per-feature path. ``mode`` defaults to GENERATION_MODE. Output order
+    matches ``retrieval_results``. Every call shares ``deadline``.
+    ``model_name=None`` lets the model tiers choose per call.
+    """
+    if not retrieval_results:
+        return []
+    workers = max(1, min(max_concurrency or GENERATION_CONCURRENCY, len(retrieval_results)))
+
+    batched = {}
+    if (mode or GENERATION_MODE) == "batched":
+        batched = generate_batched(retrieval_results, model_name=model_name, deadline=deadline)
+
+    def _one(item):
+        i, feature_data = item
+        if i - 1 in batched:
+            generated = _apply_fallbacks(dict(batched[i - 1]), feature_data)
+        else:
+            print(f"Processing {i}/{len(retrieval_results)} -> {feature_data.get('feature', 'unknown')}")
+            generated = generate_recommendation(feature_data, model_name=model_name, deadline=deadline)
+        return _build_recommendation(feature_data, generated)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="generation") as pool:
+        return list(pool.map(_one, enumerate(retrieval_results, 1)))
+
+
 def run_generation(
     face_features_path="face_features.json",
     knowledge_path="./knowledge",
     output_path="final_makeup_recommendations.json",
-    model_name="phi3"
+    model_name=None,
+    max_concurrency=None,
+    mode=None,
+    deadline=None
 ):
-    print("Indexing knowledge base...")
+    # No-op unless the knowledge files changed since the index was built
     index_knowledge(knowledge_path)
 
     print("Retrieving techniques...")
     face_features = load_face_features(face_features_path)
     retrieval_results = retrieve_from_face_features(face_features, top_k=1)
 
-    final_recommendations = []
-
-    for i, feature_data in enumerate(retrieval_results, 1):
-        feature_name = feature_data.get("feature", "unknown")
-        print(f"Processing {i}/{len(retrieval_results)} -> {feature_name}")
-
-        generated = generate_recommendation(
-            feature_data,
-            model_name=model_name
-        )
-
-        final_recommendations.append({
-            "feature": feature_name,
-            "variant": feature_data.get("variant", ""),
-            "technique": feature_data.get("technique", ""),
-            "steps": feature_data.get("steps", []),
-            "why_it_matches": generated.get("why_it_matches", ""),
-            "awareness": generated.get("awareness", "")
-        })
+    final_recommendations = generate_all(
+        retrieval_results,
+        model_name=model_name,
+        max_concurrency=max_concurrency,
+        mode=mode,
+        deadline=deadline
+    )
 
     with open(output_path, "w", encoding="utf-8") as f:
         json.dump(final_recommendations, f, ensure_ascii=False, indent=4)
@@ -207,6 +627,63 @@ def run_generation(
     print("\nGeneration complete!")
     return final_recommendations
 
+def iter_generation(
+    face_features,
+    knowledge_path="./knowledge",
+    model_name=None,
+    max_concurrency=None,
+    stream_tokens=False,
+    deadline=None
+):
+    """Run retrieval + generation, yielding events as soon as each is ready.
+
+    Events (plain dicts):
+      {"event": "retrieval", "features": [...]}              once, in output order
+      {"event": "token", "index": i, "feature": f, "text": t} only with stream_tokens
+      {"event": "recommendation", "index": i, "recommendation": {...}}
+    Recommendations are generated concurrently and emitted in completion
+    order; ``index`` is their position in the retrieval order.
+    """
+    index_knowledge(knowledge_path)
+    retrieval_results = retrieve_from_face_features(face_features, top_k=1)
+    yield {
+        "event": "retrieval",
+        "features": [
+            {"feature": f.get("feature", "unknown"), "variant": f.get("variant", "")}
+            for f in retrieval_results
+        ]
+    }
+    if not retrieval_results:
+        return
+
+    events = queue.Queue()
+    workers = max(1, min(max_concurrency or GENERATION_CONCURRENCY, len(retrieval_results)))
+
+    def _one(i, feature_data):
+        on_token = None
+        if stream_tokens:
+            feature = feature_data.get("feature", "unknown")
+            on_token = lambda text: events.put({"event": "token", "index": i, "feature": feature, "text": text})
+        generated = generate_recommendation(feature_data, model_name=model_name, on_token=on_token,
+                                            deadline=deadline)
+        return _build_recommendation(feature_data, generated)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="generation") as pool:
+        futures = {}
+        for i, feature_data in enumerate(retrieval_results):
+            future = pool.submit(_one, i, feature_data)
+            futures[future] = i
+            future.add_done_callback(events.put)
+
+        pending = len(futures)
+        while pending:
+            item = events.get()
+            if isinstance(item, dict):
+                yield item
+                continue
+            pending -= 1
+            yield {"event": "recommendation", "index": futures[item], "recommendation": item.result()}
+
 # ---------------------------
 # Main pipeline
 # ---------------------------
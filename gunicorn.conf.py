@@ -0,0 +1,9 @@
+# Loaded automatically by gunicorn from the working directory; the CMD in
+# the Dockerfile sets bind address, workers and timeouts.
+
+
+def post_fork(server, worker):
+    # Warm each worker's CPU pool, knowledge index and Ollama models, and
+    # start its job threads, before it accepts requests
+    import app
+    app.start_services()
@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import uuid
+import queue
+import sqlite3
+import threading
+import traceback
+
+# ---------------------------
+# Job statuses
+# ---------------------------
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when the backlog is at capacity."""
+
+
+def _job_view(job_id, status, created, updated, result, error):
+    return {
+        "job_id": job_id,
+        "status": status,
+        "created": created,
+        "updated": updated,
+        "result": result,
+        "error": error,
+    }
+
+
+# ---------------------------
+# Backends
+# ---------------------------
+class MemoryJobBackend:
+    """In-process queue + job table. Only visible to the process that owns it."""
+
+    def __init__(self, max_queued=16, ttl=3600):
+        self._pending = queue.Queue(maxsize=max_queued)
+        self._jobs = {}
+        self._ttl = ttl
+        self._lock = threading.Lock()
+
+    def submit(self, job_id, payload):
+        now = time.time()
+        with self._lock:
+            self._jobs[job_id] = {"status": QUEUED, "created": now, "updated": now,
+                                  "result": None, "error": None}
+        try:
+            self._pending.put_nowait((job_id, payload))
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job_id]
+            return False
+        return True
+
+    def claim(self, timeout):
+        try:
+            job_id, payload = self._pending.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job["status"], job["updated"] = RUNNING, time.time()
+        return job_id, payload
+
+    def finish(self, job_id, result=None, error=None):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.update(status=FAILED if error else DONE, updated=time.time(),
+                       result=result, error=error)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return _job_view(job_id, job["status"], job["created"], job["updated"],
+                             job["result"], job["error"])
+
+    def purge_expired(self):
+        cutoff = time.time() - self._ttl
+        with self._lock:
+            for job_id in [j for j, job in self._jobs.items()
+                           if job["status"] in (DONE, FAILED) and job["updated"] < cutoff]:
+                del self._jobs[job_id]
+
+
+class SQLiteJobBackend:
+    """Queue + job table in a local SQLite file.
+
+    Shared by every process on the node (e.g. all gunicorn workers), so a job
+    submitted to one worker can be polled through any other.
+    """
+
+    def __init__(self, path, max_queued=16, ttl=3600):
+        self._path = path
+        self._max_queued = max_queued
+        self._ttl = ttl
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._conn() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, status TEXT NOT NULL,"
+                " created REAL NOT NULL, updated REAL NOT NULL,"
+                " payload BLOB, result TEXT, error TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def submit(self, job_id, payload):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            (queued,) = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()
+            if queued >= self._max_queued:
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute(
+                "INSERT INTO jobs (id, status, created, updated, payload) VALUES (?, ?, ?, ?, ?)",
+                (job_id, QUEUED, now, now, sqlite3.Binary(payload))
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return True
+
+    def claim(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT id, payload FROM jobs WHERE status = ? ORDER BY created LIMIT 1", (QUEUED,)
+                ).fetchone()
+                if row:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, updated = ?, payload = NULL WHERE id = ?",
+                        (RUNNING, time.time(), row[0])
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            if row:
+                return row[0], bytes(row[1])
+            if time.time() >= deadline:
+                return None
+            time.sleep(0.2)
+
+    def finish(self, job_id, result=None, error=None):
+        self._conn().execute(
+            "UPDATE jobs SET status = ?, updated = ?, result = ?, error = ? WHERE id = ?",
+            (FAILED if error else DONE, time.time(),
+             json.dumps(result, ensure_ascii=False) if result is not None else None, error, job_id)
+        )
+
+    def get(self, job_id):
+        row = self._conn().execute(
+            "SELECT id, status, created, updated, result, error FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        result = json.loads(row[4]) if row[4] else None
+        return _job_view(row[0], row[1], row[2], row[3], result, row[5])
+
+    def purge_expired(self):
+        cutoff = time.time() - self._ttl
+        conn = self._conn()
+        conn.execute("DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?", (DONE, FAILED, cutoff))
+        # Jobs left running by a worker process that died never finish on their own
+        conn.execute(
+            "UPDATE jobs SET status = ?, updated = ?, payload = NULL, error = ? WHERE status = ? AND updated < ?",
+            (FAILED, time.time(), "Job interrupted", RUNNING, cutoff)
+        )
+
+
+def create_backend(kind="memory", path="./jobs.db", max_queued=16, ttl=3600):
+    if kind == "memory":
+        return MemoryJobBackend(max_queued=max_queued, ttl=ttl)
+    if kind == "sqlite":
+        return SQLiteJobBackend(path, max_queued=max_queued, ttl=ttl)
+    raise ValueError(f"Unknown job backend: {kind}")
+
+
+# ---------------------------
+# Job queue
+# ---------------------------
+class JobQueue:
+    """Bounded work queue drained by a fixed pool of worker threads.
+
+    ``handler(payload)`` returns a JSON-serialisable result; a raised
+    exception marks the job failed with its message.
+    """
+
+    def __init__(self, backend, handler, workers=2, purge_interval=60):
+        self._backend = backend
+        self._handler = handler
+        self._workers = workers
+        self._purge_interval = purge_interval
+        self._threads = []
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            for n in range(self._workers):
+                thread = threading.Thread(target=self._run, name=f"job-worker-{n}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, payload):
+        job_id = uuid.uuid4().hex
+        if not self._backend.submit(job_id, payload):
+            raise QueueFull("Job queue is full")
+        return job_id
+
+    def get(self, job_id):
+        return self._backend.get(job_id)
+
+    def _run(self):
+        last_purge = 0.0
+        while True:
+            if time.time() - last_purge > self._purge_interval:
+                last_purge = time.time()
+                try:
+                    self._backend.purge_expired()
+                except Exception:
+                    traceback.print_exc()
+
+            try:
+                claimed = self._backend.claim(timeout=1.0)
+            except Exception:
+                traceback.print_exc()
+                time.sleep(1.0)
+                continue
+            if claimed is None:
+                continue
+
+            job_id, payload = claimed
+            result, error = None, None
+            try:
+                result = self._handler(payload)
+            except Exception as e:
+                traceback.print_exc()
+                error = str(e) or e.__class__.__name__
+            try:
+                self._backend.finish(job_id, result=result, error=error)
+            except Exception:
+                traceback.print_exc()
@@ -0,0 +1,108 @@
+import os
+import json
+import argparse
+import numpy as np
+
+# -----------------------------
+# Precompiled knowledge bundle
+# -----------------------------
+# A bundle is a directory holding:
+#   meta.json       – model name, knowledge content hash and the normalized docs
+#   embeddings.npy  – float32 (n_docs, dim) document embedding matrix
+#   queries.npy     – float32 (n_queries, dim) embeddings of every intent query
+#                     the classifier can produce (strings listed in meta.json)
+# It is built once at image build time and memory-mapped by every worker, so
+# startup skips re-embedding and workers on a node share the same pages.
+BUNDLE_PATH = os.getenv("KNOWLEDGE_BUNDLE_PATH", "./knowledge_bundle")
+
+_META_FILE = "meta.json"
+_EMBEDDINGS_FILE = "embeddings.npy"
+_QUERIES_FILE = "queries.npy"
+
+
+def _save_array(path, array):
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, np.ascontiguousarray(array, dtype=np.float32))
+    os.replace(path + ".tmp", path)
+
+
+def save_bundle(bundle_dir, model_name, content_hash, docs, embeddings, queries=(), query_embeddings=None):
+    """Write ``docs``, ``queries`` and their embeddings to ``bundle_dir``.
+
+    Files are written under temporary names and renamed into place, so a
+    reader never observes a partially written bundle.
+    """
+    os.makedirs(bundle_dir, exist_ok=True)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    _save_array(os.path.join(bundle_dir, _EMBEDDINGS_FILE), embeddings)
+    if query_embeddings is None:
+        query_embeddings = np.zeros((0, embeddings.shape[1]), dtype=np.float32)
+    _save_array(os.path.join(bundle_dir, _QUERIES_FILE), query_embeddings)
+
+    meta = {
+        "model": model_name,
+        "content_hash": content_hash,
+        "dim": int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+        "docs": [
+            {"id": doc_id, "document": document, "metadata": metadata}
+            for doc_id, document, metadata in docs
+        ],
+        "queries": list(queries),
+    }
+    meta_path = os.path.join(bundle_dir, _META_FILE)
+    with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(meta_path + ".tmp", meta_path)
+
+
+def load_bundle(bundle_dir, model_name, content_hash):
+    """Load a bundle if it matches ``model_name`` and ``content_hash``.
+
+    Returns
+    -------
+    (docs, embeddings, query_table) where ``embeddings`` is a read-only memory
+    map and ``query_table`` maps each precomputed query string to its row, or
+    None when the bundle is missing, stale or unreadable.
+    """
+    try:
+        with open(os.path.join(bundle_dir, _META_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if meta.get("model") != model_name or meta.get("content_hash") != content_hash:
+        print(f"[INFO] Knowledge bundle at {bundle_dir} is stale, ignoring it")
+        return None
+
+    try:
+        embeddings = np.load(os.path.join(bundle_dir, _EMBEDDINGS_FILE), mmap_mode="r")
+        query_embeddings = np.load(os.path.join(bundle_dir, _QUERIES_FILE), mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+
+    docs = [(d["id"], d["document"], d["metadata"]) for d in meta["docs"]]
+    queries = meta.get("queries", [])
+    if embeddings.shape[0] != len(docs) or query_embeddings.shape[0] != len(queries):
+        return None
+    return docs, embeddings, dict(zip(queries, query_embeddings))
+
+
+def main():
+    from retrieve import EMBEDDING_MODEL_NAME, load_knowledge, knowledge_hash, embed_documents, all_intent_queries
+
+    parser = argparse.ArgumentParser(description="Compile knowledge/*.json into an embedding bundle.")
+    parser.add_argument("--knowledge", default="./knowledge", help="folder with knowledge JSON files")
+    parser.add_argument("--out", default=BUNDLE_PATH, help="bundle output directory")
+    args = parser.parse_args()
+
+    docs = load_knowledge(args.knowledge)
+    content_hash = knowledge_hash(args.knowledge)
+    embeddings = embed_documents([document for _, document, _ in docs])
+    queries = list(dict.fromkeys(all_intent_queries()))
+    query_embeddings = embed_documents(queries)
+    save_bundle(args.out, EMBEDDING_MODEL_NAME, content_hash, docs, embeddings, queries, query_embeddings)
+    print(f"[INFO] Wrote {len(docs)} documents and {len(queries)} queries ({content_hash[:12]}) to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,7 +10,7 @@ IMAGE_PATH = "test_img\F01.jpg"
 # -------------------------------
 # 1. Run your existing landmark extractor
 # -------------------------------
-coords, resized_shape = extract_landmarks(
+landmarks, resized_shape = extract_landmarks(
     IMAGE_PATH,
     show_steps=False,
     save_steps=False
@@ -19,15 +19,15 @@ coords, resized_shape = extract_landmarks(
 h, w, _ = resized_shape
 
 # Remove z-coordinate for accuracy computation
-detected_points = [(x, y) for (x, y, z) in coords]
+detected_points = landmarks[:, :2]
 
 # Reload resized image for annotation
 image = cv2.imread(IMAGE_PATH)
 image = cv2.resize(image, (512, 512))
 
 # Draw detected landmarks (green)
-for (x, y) in detected_points:
-    cv2.circle(image, (x, y), 1, (0, 255, 0), -1)
+for (x, y) in detected_points.astype(int):
+    cv2.circle(image, (int(x), int(y)), 1, (0, 255, 0), -1)
 
 # -------------------------------
 # 2. Manual ground-truth selection
@@ -62,20 +62,16 @@ if len(manual_points) == 0:
 # -------------------------------
 # 3. Accuracy computation
 # -------------------------------
-def euclidean(p1, p2):
-    return np.sqrt((p1[0] - p2[0])**2 + (p1[1] - p2[1])**2)
-
-pixel_errors = []
-
-for gt in manual_points:
-    distances = [euclidean(gt, dp) for dp in detected_points]
-    pixel_errors.append(min(distances))
+# Distance from every ground-truth point to its nearest detected landmark
+gt_points = np.asarray(manual_points, dtype=np.float64)
+distances = np.linalg.norm(gt_points[:, None, :] - detected_points[None, :, :], axis=2)
+pixel_errors = distances.min(axis=1)
 
 mean_pixel_error = np.mean(pixel_errors)
 max_pixel_error = np.max(pixel_errors)
 
 # Normalized error (scale-independent, research-grade)
-face_width = max([x for x, y in detected_points]) - min([x for x, y in detected_points])
+face_width = detected_points[:, 0].max() - detected_points[:, 0].min()
 normalized_error = mean_pixel_error / face_width
 
 # -------------------------------
@@ -0,0 +1,151 @@
+import os
+import queue
+import atexit
+import threading
+from contextlib import contextmanager
+
+import mediapipe as mp
+
+# Path to the FaceLandmarker model (bundled alongside this script)
+_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "face_landmarker.task")
+
+# One landmarker per request thread (gunicorn runs 2 threads per worker)
+POOL_SIZE = int(os.getenv("LANDMARKER_POOL_SIZE", 2))
+# Most faces analyzed in one image (/analyze/faces); every multi-face
+# request shares one pool built for this many
+MAX_FACES = int(os.getenv("MAX_FACES", 5))
+
+
+def create_landmarker(running_mode=None, num_faces=1):
+    """Build a FaceLandmarker (Tasks API – mediapipe ≥ 0.10.30).
+
+    IMAGE mode by default; VIDEO mode instances track a face across frames
+    and belong to a single stream, so they are never pooled.
+    """
+    if not os.path.exists(_MODEL_PATH):
+        raise FileNotFoundError(
+            f"FaceLandmarker model not found at {_MODEL_PATH}. "
+            "Download it from https://storage.googleapis.com/mediapipe-models/"
+            "face_landmarker/face_landmarker/float16/latest/face_landmarker.task"
+        )
+
+    base_options = mp.tasks.BaseOptions(model_asset_path=_MODEL_PATH)
+    options = mp.tasks.vision.FaceLandmarkerOptions(
+        base_options=base_options,
+        running_mode=running_mode or mp.tasks.vision.RunningMode.IMAGE,
+        num_faces=num_faces,
+        min_face_detection_confidence=0.5,
+        output_face_blendshapes=False,
+        output_facial_transformation_matrixes=False,
+    )
+    return mp.tasks.vision.FaceLandmarker.create_from_options(options)
+
+
+class LandmarkerPool:
+    """Process-level pool of FaceLandmarker instances.
+
+    FaceLandmarker is not safe to share across threads, so every instance is
+    leased to exactly one caller at a time. Instances are created lazily up to
+    ``size`` and reused afterwards; an instance whose ``detect`` raised is
+    closed and replaced on the next lease.
+    """
+
+    def __init__(self, size=POOL_SIZE, factory=create_landmarker):
+        self._size = max(1, size)
+        self._factory = factory
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def warm_up(self):
+        """Create every instance up front so the first requests skip model load."""
+        while True:
+            with self._lock:
+                if self._created >= self._size:
+                    return
+                self._created += 1
+            self._idle.put(self._build())
+
+    def _build(self):
+        try:
+            return self._factory()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def _acquire(self, timeout):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self._size
+            if can_create:
+                self._created += 1
+        if can_create:
+            return self._build()
+
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("Timed out waiting for a free FaceLandmarker") from None
+
+    def _discard(self, landmarker):
+        with self._lock:
+            self._created -= 1
+        try:
+            landmarker.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def lease(self, timeout=None):
+        """Borrow a landmarker for the duration of a ``with`` block."""
+        landmarker = self._acquire(timeout)
+        try:
+            yield landmarker
+        except Exception:
+            print("[WARN] FaceLandmarker failed, recreating instance")
+            self._discard(landmarker)
+            raise
+        else:
+            self._idle.put(landmarker)
+
+    def close(self):
+        while True:
+            try:
+                landmarker = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(landmarker)
+
+
+# num_faces is fixed when a FaceLandmarker is built. There are two pools:
+# single-face, and MAX_FACES for any multi-face request (callers keep the
+# first num_faces detections), so no request builds a model of its own.
+_pools = {}
+_pool_lock = threading.Lock()
+
+
+def get_pool(num_faces=1):
+    """Return the process-wide pool serving ``num_faces``, creating it on first call."""
+    num_faces = 1 if num_faces <= 1 else MAX_FACES
+    pool = _pools.get(num_faces)
+    if pool is None:
+        with _pool_lock:
+            pool = _pools.get(num_faces)
+            if pool is None:
+                pool = LandmarkerPool(size=POOL_SIZE, factory=lambda: create_landmarker(num_faces=num_faces))
+                _pools[num_faces] = pool
+                atexit.register(pool.close)
+    return pool
+
+
+def warm_up_landmarkers():
+    print(f"[INFO] Warming up {POOL_SIZE} FaceLandmarker instance(s)...")
+    get_pool().warm_up()
+    if MAX_FACES > 1:
+        print(f"[INFO] Warming up {POOL_SIZE} multi-face FaceLandmarker instance(s) (up to {MAX_FACES} faces)...")
+        get_pool(MAX_FACES).warm_up()
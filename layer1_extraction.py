@@ -1,103 +1,177 @@
 import cv2
 import mediapipe as mp
-import os
+import numpy as np
+
+from landmarker_pool import get_pool
+from visualization import preprocessing_steps
+
+
+# Every image is resized to this square before detection
+TARGET_SIZE = 512
+
+# JPEG start-of-frame markers carry the image dimensions
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# Reduced-resolution decode flags, largest reduction first
+_REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def _jpeg_size(data):
+    """Return (width, height) from a JPEG header without decoding, or None."""
+    if data[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:  # standalone markers
+            i += 2
+            continue
+        if marker in _JPEG_SOF_MARKERS:
+            height = int.from_bytes(data[i + 5:i + 7], "big")
+            width = int.from_bytes(data[i + 7:i + 9], "big")
+            return width, height
+        i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+    return None
+
+
+def decode_image(data):
+    """Decode raw image bytes in memory (no temp file).
+
+    Large JPEGs are decoded at 1/2, 1/4 or 1/8 resolution when the result is
+    still at least TARGET_SIZE on both sides, since everything is resized to
+    TARGET_SIZE x TARGET_SIZE anyway.
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    flag = cv2.IMREAD_COLOR
+    size = _jpeg_size(data)
+    if size:
+        for factor, reduced in _REDUCED_FLAGS:
+            if min(size) // factor >= TARGET_SIZE:
+                flag = reduced
+                break
+    image_bgr = cv2.imdecode(buf, flag)
+    if image_bgr is None:
+        raise ValueError("Could not decode image")
+    return image_bgr
 
-# Path to the FaceLandmarker model (bundled alongside this script)
-_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "face_landmarker.task")
 
+def load_image(image):
+    """Return a BGR array from a file path, raw bytes or an existing array."""
+    if isinstance(image, np.ndarray):
+        if image.ndim != 3 or image.shape[2] != 3:
+            raise ValueError("Expected a BGR image array of shape (H, W, 3)")
+        return image
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return decode_image(bytes(image))
 
-def extract_landmarks(image_path, show_steps=True, save_steps=True):
-    print("[INFO] Loading image...")
-    image_bgr = cv2.imread(image_path)
+    image_bgr = cv2.imread(image)
     if image_bgr is None:
         raise ValueError("Image not found")
-
-    # Create output folder for saving images
-    output_dir = "preprocessing_outputs"
-    os.makedirs(output_dir, exist_ok=True)
-
-    # Original image
-    original = image_bgr.copy()
-    if save_steps:
-        cv2.imwrite(f"{output_dir}/1_original.jpg", original)
-
-    # Resize (standardization)
-    resized = cv2.resize(original, (512, 512))
-    if save_steps:
-        cv2.imwrite(f"{output_dir}/2_resized.jpg", resized)
-
-    # Convert to RGB
+    return image_bgr
+
+
+def landmark_array(face_lms, width, height, indices=None):
+    """Pack MediaPipe landmarks into a (478, 3) float32 array of (x_px, y_px, z).
+
+    With ``indices`` only those rows are filled and the rest are NaN, which
+    avoids touching the remaining landmark objects.
+    """
+    n = len(face_lms)
+    if indices is None:
+        landmarks = np.fromiter(
+            (v for lm in face_lms for v in (lm.x, lm.y, lm.z)), dtype=np.float32, count=3 * n
+        ).reshape(n, 3)
+    else:
+        landmarks = np.full((n, 3), np.nan, dtype=np.float32)
+        for i in indices:
+            lm = face_lms[i]
+            landmarks[i] = (lm.x, lm.y, lm.z)
+    landmarks[:, 0] *= width
+    landmarks[:, 1] *= height
+    return landmarks
+
+
+def detect_faces(image, num_faces=1, indices=None):
+    """Inference-only Layer 1 for up to ``num_faces`` faces in one detector pass.
+
+    Returns ``(landmarks, resized)`` where ``landmarks`` is an (F, 478, 3)
+    float32 array (1 ≤ F ≤ min(num_faces, MAX_FACES) detected faces) and ``resized`` the
+    TARGET_SIZE x TARGET_SIZE BGR image they refer to.
+    """
+    image_bgr = load_image(image)
+
+    # Resize (standardization) and convert to RGB – FaceLandmarker expects an mp.Image in RGB format
+    resized = cv2.resize(image_bgr, (TARGET_SIZE, TARGET_SIZE))
     rgb_image = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
-    if save_steps:
-        cv2.imwrite(f"{output_dir}/3_rgb.jpg", cv2.cvtColor(rgb_image, cv2.COLOR_RGB2BGR))
-
-    # Initialize MediaPipe FaceLandmarker (Tasks API – mediapipe ≥ 0.10.30)
-    print("[INFO] Initializing MediaPipe FaceLandmarker...")
-    if not os.path.exists(_MODEL_PATH):
-        raise FileNotFoundError(
-            f"FaceLandmarker model not found at {_MODEL_PATH}. "
-            "Download it from https://storage.googleapis.com/mediapipe-models/"
-            "face_landmarker/face_landmarker/float16/latest/face_landmarker.task"
-        )
-
-    base_options = mp.tasks.BaseOptions(model_asset_path=_MODEL_PATH)
-    options = mp.tasks.vision.FaceLandmarkerOptions(
-        base_options=base_options,
-        num_faces=1,
-        min_face_detection_confidence=0.5,
-        output_face_blendshapes=False,
-        output_facial_transformation_matrixes=False,
-    )
-    landmarker = mp.tasks.vision.FaceLandmarker.create_from_options(options)
-
-    print("[INFO] Running face landmark detection...")
-    # FaceLandmarker expects an mp.Image in RGB format
     mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=rgb_image)
-    result = landmarker.detect(mp_image)
-    landmarker.close()
+
+    # Lease a warm landmarker from the process pool instead of loading the model per call
+    with get_pool(num_faces).lease() as landmarker:
+        result = landmarker.detect(mp_image)
 
     if not result.face_landmarks:
         raise ValueError("No face detected")
 
-    # Extract ALL landmarks (same tuple format as before: (x_px, y_px, z))
+    # The shared multi-face landmarker may find more faces than asked for
     h, w, _ = resized.shape
-    face_lms = result.face_landmarks[0]
-    coords = [(int(lm.x * w), int(lm.y * h), lm.z) for lm in face_lms]
-    print(f"[INFO] {len(coords)} landmarks extracted")
-
-    # Draw mesh and highlight all coordinates
-    annotated = resized.copy()
-    connections = mp.tasks.vision.FaceLandmarksConnections.FACE_LANDMARKS_TESSELATION
-    for conn in connections:
-        x1, y1, _ = coords[conn.start]
-        x2, y2, _ = coords[conn.end]
-        cv2.line(annotated, (x1, y1), (x2, y2), (192, 192, 192), 1)
-
-    # Highlight all landmarks (small green dots)
-    for idx, (x, y, _) in enumerate(coords):
-        cv2.circle(annotated, (x, y), 1, (0, 255, 0), -1)
-        if idx % 25 == 0:
-            cv2.putText(
-                annotated,
-                str(idx),
-                (x + 2, y + 2),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                0.25,
-                (0, 255, 255),
-                1
-            )
-
-    if save_steps:
-        cv2.imwrite(f"{output_dir}/4_face_mesh_landmarks.jpg", annotated)
-
-    # Show preprocessing stages
-    if show_steps:
-        cv2.imshow("1. Original Image", original)
-        cv2.imshow("2. Resized Image", resized)
-        cv2.imshow("3. RGB Converted Image", rgb_image)
-        cv2.imshow("4. Face Mesh & All Landmarks", annotated)
-        cv2.waitKey(0)
-        cv2.destroyAllWindows()
+    landmarks = np.stack([landmark_array(face_lms, w, h, indices) for face_lms in result.face_landmarks[:num_faces]])
+    return landmarks, resized
+
+
+def detect_landmarks(image, indices=None):
+    """Inference-only Layer 1: load, resize, detect.
+
+    Returns ``(landmarks, resized)`` where ``landmarks`` is a (478, 3)
+    float32 array of sub-pixel x, y and MediaPipe's relative z, and
+    ``resized`` the TARGET_SIZE x TARGET_SIZE BGR image it refers to. Pass
+    ``indices`` (e.g. ``layer2_metrics.LANDMARK_INDICES``) for sparse mode:
+    only those rows are filled, the rest are NaN.
+    """
+    landmarks, resized = detect_faces(image, num_faces=1, indices=indices)
+    return landmarks[0], resized
+
+
+def face_boxes(landmarks, width=TARGET_SIZE, height=TARGET_SIZE):
+    """Bounding box of each face in ``landmarks`` (F, 478, 3), normalized to [0, 1].
+
+    Returns a list of {"x", "y", "width", "height"} dicts, independent of the
+    resolution the image was decoded at.
+    """
+    x = landmarks[..., 0] / width
+    y = landmarks[..., 1] / height
+    x_min, x_max = np.fmin.reduce(x, axis=1).clip(0, 1), np.fmax.reduce(x, axis=1).clip(0, 1)
+    y_min, y_max = np.fmin.reduce(y, axis=1).clip(0, 1), np.fmax.reduce(y, axis=1).clip(0, 1)
+    return [
+        {"x": round(float(x0), 4), "y": round(float(y0), 4),
+         "width": round(float(x1 - x0), 4), "height": round(float(y1 - y0), 4)}
+        for x0, x1, y0, y1 in zip(x_min, x_max, y_min, y_max)
+    ]
+
+
+def extract_landmarks(image, show_steps=True, save_steps=True, indices=None):
+    """Run Layer 1 on ``image`` – a file path, raw encoded bytes or a BGR array.
+
+    Returns ``(landmarks, resized_shape)``; see detect_landmarks. The
+    preprocessing stages are only rendered when shown or saved.
+    """
+    print("[INFO] Loading image...")
+    image_bgr = load_image(image)
+
+    print("[INFO] Running face landmark detection...")
+    landmarks, resized = detect_landmarks(image_bgr, indices)
+    print(f"[INFO] {len(landmarks) if indices is None else len(indices)} landmarks extracted")
+
+    preprocessing_steps(image_bgr, resized, landmarks, show_steps=show_steps, save_steps=save_steps)
 
     print("[INFO] Preprocessing & landmark extraction complete.")
-    return coords, resized.shape
+    return landmarks, resized.shape
@@ -1,90 +1,124 @@
 import math
+import numpy as np
 
-def calculate_metrics(coords, resized):
+# --- Landmark index tables (MediaPipe 478-point face mesh) ---
+# Horizontal distances normalized by face width: metric -> (landmark a, landmark b)
+_WIDTH_METRICS = {
+    'inter_eye_distance': (263, 33),      # right / left eye center
+    'left_eye_width': (133, 173),
+    'right_eye_width': (362, 386),
+    'nose_width': (327, 98),              # nose right / left
+    'lip_width': (291, 61),               # lip right / left
+    'jaw_width': (454, 234),              # jaw right / left
+    'cheekbone_prominence': (454, 234),   # right / left cheek
+}
+# Vertical distances normalized by face height
+_HEIGHT_METRICS = {
+    'eye_symmetry': (33, 263),            # left / right eye center
+    'left_eye_height': (159, 145),
+    'right_eye_height': (386, 374),
+    'nose_length': (1, 168),              # nose tip / bridge
+    'upper_lip_height': (13, 14),         # upper / lower lip
+    'lower_lip_height': (14, 13),
+    'cheekbone_height': (10, 152),        # cheek top / chin
+}
+# Eyebrow slopes: metric -> (inner, outer)
+_ANGLE_METRICS = {
+    'left_brow_angle': (105, 65),
+    'right_brow_angle': (334, 295),
+}
+_CHIN = 152
+# Face outline; its extremes give the face bounding box when only a sparse
+# set of landmarks is materialized
+_FACE_OVAL = (
+    10, 338, 297, 332, 284, 251, 389, 356, 454, 323, 361, 288, 397, 365, 379, 378, 400, 377,
+    152, 148, 176, 149, 150, 136, 172, 58, 132, 93, 234, 127, 162, 21, 54, 103, 67, 109,
+)
 
-    h, w, _ = resized
-    metrics = {}
+# libm atan2 applied elementwise: NumPy's SIMD arctan2 can differ from
+# math.atan2 in the last ulp, and metrics must not depend on the code path.
+_atan2 = np.frompyfunc(math.atan2, 2, 1)
+
+_W_NAMES = list(_WIDTH_METRICS)
+_W_A, _W_B = (np.array(idx) for idx in zip(*_WIDTH_METRICS.values()))
+_H_NAMES = list(_HEIGHT_METRICS)
+_H_A, _H_B = (np.array(idx) for idx in zip(*_HEIGHT_METRICS.values()))
+_A_NAMES = list(_ANGLE_METRICS)
+_A_INNER, _A_OUTER = (np.array(idx) for idx in zip(*_ANGLE_METRICS.values()))
+
+# Every landmark index the metrics read (for Layer 1's sparse mode)
+LANDMARK_INDICES = tuple(sorted(
+    set(_FACE_OVAL) | {_CHIN}
+    | {i for table in (_WIDTH_METRICS, _HEIGHT_METRICS, _ANGLE_METRICS) for pair in table.values() for i in pair}
+))
+
+# Output order (matches the original per-face implementation)
+METRIC_NAMES = [
+    'face_width', 'face_height', 'face_ratio',
+    'inter_eye_distance', 'eye_symmetry',
+    'left_eye_width', 'left_eye_height', 'right_eye_width', 'right_eye_height',
+    'nose_width', 'nose_length',
+    'upper_lip_height', 'lower_lip_height', 'lip_width',
+    'left_brow_angle', 'right_brow_angle',
+    'jaw_width', 'chin_projection',
+    'cheekbone_prominence', 'cheekbone_height',
+]
+
+
+def calculate_metrics_batch(landmarks):
+    """Compute every metric for a batch of faces at once.
+
+    Parameters
+    ----------
+    landmarks : array-like, shape (N, 478, 2 or 3)
+        Pixel x, y (and optional z) per landmark for N faces. Rows of
+        landmarks that were not materialized (sparse mode) are NaN and
+        are ignored for the face bounding box.
+
+    Returns
+    -------
+    dict mapping each name in METRIC_NAMES to an (N,) array.
+    """
+    pts = np.asarray(landmarks)
+    # Ratios are computed in double precision from float32 landmarks
+    x = pts[..., 0].astype(np.float64)
+    y = pts[..., 1].astype(np.float64)
 
     # --- Face Dimensions ---
-    x_coords = [x for x, y, z in coords]
-    y_coords = [y for x, y, z in coords]
-    face_width = max(x_coords) - min(x_coords)
-    face_height = max(y_coords) - min(y_coords)
-    metrics['face_width'] = face_width
-    metrics['face_height'] = face_height
-    # Facial index = height / width, used in anthropometry
-    metrics['face_ratio'] = face_height / face_width
-
-    # --- Eyes ---
-    left_eye_center = coords[33]   # approximate left eye center
-    right_eye_center = coords[263] # approximate right eye center
-
-    # Eye spacing (interocular distance) normalized by face width
-    metrics['inter_eye_distance'] = abs(right_eye_center[0] - left_eye_center[0]) / face_width
-
-    # Eye symmetry: vertical alignment difference normalized by face height
-    metrics['eye_symmetry'] = abs(left_eye_center[1] - right_eye_center[1]) / face_height
-
-    # Left eye width & height
-    metrics['left_eye_width'] = abs(coords[133][0] - coords[173][0]) / face_width
-    metrics['left_eye_height'] = abs(coords[159][1] - coords[145][1]) / face_height
-
-    # Right eye width & height
-    metrics['right_eye_width'] = abs(coords[362][0] - coords[386][0]) / face_width
-    metrics['right_eye_height'] = abs(coords[386][1] - coords[374][1]) / face_height
-
-    # --- Nose ---
-    nose_tip = coords[1]
-    nose_bridge = coords[168]
-    nose_left = coords[98]
-    nose_right = coords[327]
-    # Nasal index: width / length ratios normalized
-    metrics['nose_width'] = abs(nose_right[0] - nose_left[0]) / face_width
-    metrics['nose_length'] = abs(nose_tip[1] - nose_bridge[1]) / face_height
-
-    # --- Lips ---
-    upper_lip = coords[13]
-    lower_lip = coords[14]
-    lip_left = coords[61]
-    lip_right = coords[291]
-    # Lip height: upper + lower relative to face height
-    metrics['upper_lip_height'] = abs(upper_lip[1] - lower_lip[1]) / face_height
-    metrics['lower_lip_height'] = abs(lower_lip[1] - upper_lip[1]) / face_height
-    # Lip width normalized to face width
-    metrics['lip_width'] = abs(lip_right[0] - lip_left[0]) / face_width
-
-    # --- Eyebrows ---
-    left_brow_inner = coords[105]
-    left_brow_outer = coords[65]
-    right_brow_inner = coords[334]
-    right_brow_outer = coords[295]
-
-    # Slope-based eyebrow angle in degrees
-    metrics['left_brow_angle'] = math.degrees(math.atan2(
-        left_brow_outer[1] - left_brow_inner[1],
-        left_brow_outer[0] - left_brow_inner[0]
-    ))
-    metrics['right_brow_angle'] = math.degrees(math.atan2(
-        right_brow_outer[1] - right_brow_inner[1],
-        right_brow_outer[0] - right_brow_inner[0]
-    ))
-
-    # --- Jaw & Chin ---
-    jaw_left = coords[234]
-    jaw_right = coords[454]
-    chin = coords[152]
-    # Jaw width / face width ratio
-    metrics['jaw_width'] = abs(jaw_right[0] - jaw_left[0]) / face_width
-    # Chin projection relative to face height (distance from top of face)
-    metrics['chin_projection'] = (chin[1] - min(y_coords)) / face_height
-
-    # --- Cheekbones ---
-    left_cheek = coords[234]
-    right_cheek = coords[454]
-    cheek_top = coords[10]  # approximate top of cheek
-    # Cheekbone prominence = horizontal distance normalized by face width
-    metrics['cheekbone_prominence'] = abs(right_cheek[0] - left_cheek[0]) / face_width
-    # Cheekbone height = vertical distance from chin to cheek top normalized by face height
-    metrics['cheekbone_height'] = abs(cheek_top[1] - chin[1]) / face_height
-
-    return metrics
+    y_min = np.fmin.reduce(y, axis=1)
+    face_width = np.fmax.reduce(x, axis=1) - np.fmin.reduce(x, axis=1)
+    face_height = np.fmax.reduce(y, axis=1) - y_min
+
+    metrics = {
+        'face_width': face_width,
+        'face_height': face_height,
+        # Facial index = height / width, used in anthropometry
+        'face_ratio': face_height / face_width,
+    }
+
+    # --- Eyes, nose, lips, jaw & cheekbones: normalized distances ---
+    widths = np.abs(x[:, _W_A] - x[:, _W_B]) / face_width[:, None]
+    heights = np.abs(y[:, _H_A] - y[:, _H_B]) / face_height[:, None]
+    metrics.update(zip(_W_NAMES, widths.T))
+    metrics.update(zip(_H_NAMES, heights.T))
+
+    # --- Eyebrows: slope-based angle in degrees ---
+    angles = np.degrees(_atan2(
+        y[:, _A_OUTER] - y[:, _A_INNER],
+        x[:, _A_OUTER] - x[:, _A_INNER]
+    ).astype(np.float64))
+    metrics.update(zip(_A_NAMES, angles.T))
+
+    # --- Chin projection relative to face height (distance from top of face) ---
+    metrics['chin_projection'] = (y[:, _CHIN] - y_min) / face_height
+
+    return {name: metrics[name] for name in METRIC_NAMES}
+
+
+def calculate_metrics(landmarks, resized):
+    """Per-face wrapper around calculate_metrics_batch returning plain floats.
+
+    ``landmarks`` is the (478, 3) array returned by Layer 1.
+    """
+    batch = calculate_metrics_batch(np.asarray(landmarks)[None])
+    return {name: values[0].item() for name, values in batch.items()}
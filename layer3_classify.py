@@ -1,135 +1,162 @@
-def classify_features(metrics):
+import os
+import json
+import numpy as np
+
+# Thresholds and labels live in a declarative rules table so they can be
+# tuned without touching code. Each rule is either
+#   - a binning rule: "metric", ascending "bins" and len(bins) + 1 "labels".
+#     A value lands in bin i when it has passed i thresholds; a threshold is
+#     passed when value >= bin (value > bin where "right" is true), so
+#     `x < t` chains use the default and `x > t` chains use "right": true.
+#   - a case rule: ordered "cases" matching labels of earlier rules, plus
+#     a "default" label.
+# Rules with an "output" of [section, field] name the classify_features
+# result field they fill, which also defines LABELS.
+RULES_PATH = os.getenv(
+    "CLASSIFY_RULES_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "classify_rules.json")
+)
+
+
+class _BinRule:
+    def __init__(self, spec):
+        self.name = spec["name"]
+        self.metric = spec["metric"]
+        self.thresholds = np.asarray(spec["bins"], dtype=np.float64)
+        right = spec.get("right", False)
+        if isinstance(right, bool):
+            right = [right] * len(self.thresholds)
+        self.right = np.asarray(right, dtype=bool)
+        self.labels = np.empty(len(spec["labels"]), dtype=object)
+        self.labels[:] = spec["labels"]
+
+        if len(self.labels) != len(self.thresholds) + 1 or len(self.right) != len(self.thresholds):
+            raise ValueError(f"Rule {self.name}: needs len(bins) + 1 labels and one 'right' flag per bin")
+        if np.any(np.diff(self.thresholds) < 0):
+            raise ValueError(f"Rule {self.name}: bins must be ascending")
+
+    def evaluate(self, values, labels):
+        x = values[self.metric][:, None]
+        # `not x < t` rather than `x >= t` so NaN behaves like the old if/elif chains
+        passed = np.where(self.right, x > self.thresholds, ~(x < self.thresholds))
+        return self.labels[passed.sum(axis=1)]
+
+    def all_labels(self):
+        return list(self.labels)
+
+
+class _CaseRule:
+    def __init__(self, spec):
+        self.name = spec["name"]
+        self.cases = [(case["when"], case["label"]) for case in spec["cases"]]
+        self.default = spec["default"]
+
+    def evaluate(self, values, labels):
+        n = len(next(iter(values.values())))
+        conditions, choices = [], []
+        for when, label in self.cases:
+            conditions.append(np.logical_and.reduce([labels[rule] == want for rule, want in when.items()]))
+            choice = np.empty(n, dtype=object)
+            choice[:] = label
+            choices.append(choice)
+        default = np.empty(n, dtype=object)
+        default[:] = self.default
+        return np.select(conditions, choices, default)
+
+    def all_labels(self):
+        return [label for _, label in self.cases] + [self.default]
+
+
+def load_rules(path=RULES_PATH):
+    """Compile the rules table at ``path`` into evaluators (done once at import)."""
+    with open(path, "r", encoding="utf-8") as f:
+        specs = json.load(f)["rules"]
+    rules = [(_CaseRule if "cases" in spec else _BinRule)(spec) for spec in specs]
+    outputs = {spec["name"]: tuple(spec["output"]) for spec in specs if spec.get("output")}
+    return rules, outputs
+
+
+_RULES, _OUTPUTS = load_rules()
+
+# Every label classify_features can emit, per (section, field) of its result.
+# Retrieval precomputes its query embeddings from this closed set.
+LABELS = {
+    _OUTPUTS[rule.name]: tuple(dict.fromkeys(label for label in rule.all_labels() if label is not None))
+    for rule in _RULES if rule.name in _OUTPUTS
+}
+
+
+def _derived_metrics(metrics):
+    """Layer 2 metrics plus the combined quantities the rules bin on."""
+    values = {name: np.asarray(v, dtype=np.float64).reshape(-1) for name, v in metrics.items()}
+    upper, lower = values['upper_lip_height'], values['lower_lip_height']
+    with np.errstate(divide="ignore", invalid="ignore"):
+        values['eye_ratio'] = (values['left_eye_height'] + values['right_eye_height']) / \
+                              (values['left_eye_width'] + values['right_eye_width'])
+        values['ul_lr_ratio'] = np.where(lower != 0, upper / np.where(lower != 0, lower, 1), 1.0)
+    values['eye_height_diff'] = np.abs(values['left_eye_height'] - values['right_eye_height'])
+    values['lip_fullness'] = upper + lower
+    values['brow_angle'] = (values['left_brow_angle'] + values['right_brow_angle']) / 2
+    return values
+
+
+def evaluate_rules(metrics):
+    """Vectorized rule evaluation.
+
+    Parameters
+    ----------
+    metrics : dict of name -> (N,) array (e.g. from calculate_metrics_batch)
+
+    Returns
+    -------
+    (values, labels): derived metric arrays and rule name -> (N,) label arrays.
+    """
+    values = _derived_metrics(metrics)
+    labels = {}
+    for rule in _RULES:
+        labels[rule.name] = rule.evaluate(values, labels)
+    return values, labels
+
+
+def _describe(row, values, labels):
+    """Assemble the result dict and human-readable text for one face."""
+    v = {name: arr[row].item() for name, arr in values.items()}
+    lab = {name: arr[row] for name, arr in labels.items()}
 
     result = {}
     human_text = []
 
-    # --- FACE SHAPE (Facial Index) ---
-    # Facial index (height/width) is a widely used anthropometric measure
-    ratio = metrics['face_ratio']
-    if ratio < 0.85:
-        face_shape = 'broad'  # corresponds to euryprosopic/hypereuryprosopic
-        secondary = None
-    elif ratio < 0.90:
-        face_shape = 'round'  # mesoprosopic
-        secondary = None
-    elif ratio < 0.95:
-        face_shape = 'oval'  # leptoprosopic
-        secondary = 'round'
-    elif ratio < 1.00:
-        face_shape = 'long'  # hyperleptoprosopic
-        secondary = 'oval'
-    else:
-        face_shape = 'very long'
-        secondary = 'long'
-    result['face_shape'] = {'primary': face_shape, 'secondary': secondary, 'ratio': ratio}
+    # --- FACE SHAPE ---
+    face_shape, secondary = lab['face_shape'], lab['face_secondary']
+    result['face_shape'] = {'primary': face_shape, 'secondary': secondary, 'ratio': v['face_ratio']}
     label = f"Your face shape is {face_shape}"
     if secondary:
         label += f" with subtle {secondary} influence"
     human_text.append(label + ".")
 
     # --- FACE SYMMETRY ---
-    # Eye alignment difference normalized; smaller is better symmetry
-    sym = metrics['eye_symmetry']
-    if sym < 0.015:
-        symmetry = 'high'
-    elif sym < 0.03:
-        symmetry = 'moderate'
-    else:
-        symmetry = 'noticeable asymmetry'
-    result['face_symmetry'] = {'level': symmetry, 'eye_alignment': sym}
+    symmetry = lab['symmetry']
+    result['face_symmetry'] = {'level': symmetry, 'eye_alignment': v['eye_symmetry']}
     human_text.append(f"Your facial symmetry is {symmetry}.")
 
-    # --- NOSE (Nasal index) ---
-    # Width / length ratios used in anthropometry
-    nose_ratio = metrics['nose_width']
-    if nose_ratio < 0.14:
-        nose_width = 'narrow'
-    elif nose_ratio < 0.18:
-        nose_width = 'average'
-    else:
-        nose_width = 'wide'
-
-    nose_length = metrics['nose_length']
-    if nose_length < 0.28:
-        nose_length_type = 'short'
-    elif nose_length < 0.36:
-        nose_length_type = 'average'
-    else:
-        nose_length_type = 'long'
-
-    # Tip shape derived from width and length
-    if nose_length_type == 'short' and nose_width == 'narrow':
-        nose_tip = 'rounded'
-    elif nose_width == 'wide':
-        nose_tip = 'soft curve'
-    else:
-        nose_tip = 'defined'
-
+    # --- NOSE ---
+    nose_width, nose_length_type, nose_tip = lab['nose_width'], lab['nose_length'], lab['nose_tip']
     result['nose'] = {'width': nose_width, 'length': nose_length_type, 'tip': nose_tip,
-                      'metrics': {'width_ratio': nose_ratio, 'length_ratio': nose_length}}
+                      'metrics': {'width_ratio': v['nose_width'], 'length_ratio': v['nose_length']}}
     human_text.append(f"Your nose is {nose_width} in width, {nose_length_type} in length, with a {nose_tip} tip.")
 
     # --- EYES ---
-    # Eye height/width ratios describe shape; inter-eye distance describes spacing
-    eye_ratio = (metrics['left_eye_height'] + metrics['right_eye_height']) / \
-                (metrics['left_eye_width'] + metrics['right_eye_width'])
-    if eye_ratio > 0.8:
-        eye_shape = 'round'
-    elif eye_ratio > 0.6:
-        eye_shape = 'almond'
-    else:
-        eye_shape = 'hooded'
-
-    diff = metrics['left_eye_height'] - metrics['right_eye_height']
-    if abs(diff) > 0.02:
-        eye_orientation = 'asymmetric'
-    else:
-        eye_orientation = 'balanced'
-
-    inter_eye_ratio = metrics['inter_eye_distance']
-    if inter_eye_ratio < 0.32:
-        eye_spacing = 'close-set'
-    elif inter_eye_ratio < 0.36:
-        eye_spacing = 'balanced'
-    else:
-        eye_spacing = 'wide-set'
-
+    eye_shape, eye_orientation, eye_spacing = lab['eye_shape'], lab['eye_orientation'], lab['eye_spacing']
     result['eyes'] = {'shape': eye_shape, 'orientation': eye_orientation, 'spacing': eye_spacing,
-                      'metrics': {'eye_ratio': eye_ratio, 'inter_eye_distance': inter_eye_ratio}}
+                      'metrics': {'eye_ratio': v['eye_ratio'], 'inter_eye_distance': v['inter_eye_distance']}}
     human_text.append(f"Your eyes are {eye_shape}, {eye_orientation}, and {eye_spacing}.")
 
     # --- LIPS ---
-    # Fullness = upper + lower height; balance = upper/lower ratio
-    upper = metrics['upper_lip_height']
-    lower = metrics['lower_lip_height']
-    fullness_ratio = upper + lower
-    if fullness_ratio < 0.05:
-        lip_fullness = 'thin'
-        secondary = 'medium' if fullness_ratio > 0.045 else None
-    elif fullness_ratio < 0.08:
-        lip_fullness = 'medium'
-        secondary = 'thin' if fullness_ratio < 0.055 else 'full'
-    else:
-        lip_fullness = 'full'
-        secondary = 'medium' if fullness_ratio < 0.09 else None
-
-    ul_lr_ratio = upper / lower if lower != 0 else 1
-    if ul_lr_ratio > 1.05:
-        lip_balance = 'upper-dominant'
-    elif ul_lr_ratio < 0.95:
-        lip_balance = 'lower-dominant'
-    else:
-        lip_balance = 'balanced'
-
-    if lip_fullness == 'full' and lip_balance == 'balanced':
-        lip_contour = 'pouty'
-    elif lip_fullness == 'medium' and lip_balance == 'upper-dominant':
-        lip_contour = 'bow-shaped'
-    else:
-        lip_contour = 'natural'
-
+    lip_fullness, secondary = lab['lip_fullness'], lab['lip_secondary']
+    lip_balance, lip_contour = lab['lip_balance'], lab['lip_contour']
+    ul_lr_ratio = v['ul_lr_ratio'] if v['lower_lip_height'] != 0 else 1
     result['lips'] = {'fullness': lip_fullness, 'secondary': secondary, 'balance': lip_balance,
-                      'contour': lip_contour, 'metrics': {'fullness_ratio': fullness_ratio, 'ul_lr_ratio': ul_lr_ratio}}
+                      'contour': lip_contour, 'metrics': {'fullness_ratio': v['lip_fullness'], 'ul_lr_ratio': ul_lr_ratio}}
     lip_label = f"Your lips are {lip_fullness}"
     if secondary:
         lip_label += f" with mild {secondary} influence"
@@ -137,57 +164,33 @@ def classify_features(metrics):
     human_text.append(lip_label)
 
     # --- EYEBROWS ---
-    avg_angle = (metrics['left_brow_angle'] + metrics['right_brow_angle']) / 2
-    if avg_angle < 5:
-        arch_type = 'straight'
-    elif avg_angle < 15:
-        arch_type = 'soft arch'
-    else:
-        arch_type = 'defined arch'
-    result['eyebrows'] = {'arch': arch_type, 'thickness': 'natural', 'angle': avg_angle}
+    arch_type = lab['brow_arch']
+    result['eyebrows'] = {'arch': arch_type, 'thickness': 'natural', 'angle': v['brow_angle']}
     human_text.append(f"Your eyebrows are {arch_type} with natural thickness.")
 
     # --- JAW & CHIN ---
-    jaw_width_ratio = metrics['jaw_width']
-    if jaw_width_ratio < 0.35:
-        jaw_type = 'narrow'
-    elif jaw_width_ratio < 0.45:
-        jaw_type = 'balanced'
-    else:
-        jaw_type = 'wide'
-
-    chin_proj = metrics['chin_projection']
-    if chin_proj < 0.03:
-        chin_shape = 'pointed'
-    elif chin_proj < 0.05:
-        chin_shape = 'balanced'
-    else:
-        chin_shape = 'prominent'
-
+    jaw_type, chin_shape = lab['jaw'], lab['chin']
     result['jaw_chin'] = {'jaw': jaw_type, 'chin_shape': chin_shape,
-                          'metrics': {'jaw_width_ratio': jaw_width_ratio, 'chin_projection': chin_proj}}
+                          'metrics': {'jaw_width_ratio': v['jaw_width'], 'chin_projection': v['chin_projection']}}
     human_text.append(f"Your jaw is {jaw_type} and your chin is {chin_shape}.")
 
     # --- CHEEKBONES ---
-    cheek_prom = metrics['cheekbone_prominence']
-    cheek_height = metrics['cheekbone_height']
-
-    if cheek_prom < 0.8:
-        cheek_prom_label = 'subtle'
-    elif cheek_prom < 1.0:
-        cheek_prom_label = 'moderate'
-    else:
-        cheek_prom_label = 'prominent'
-
-    if cheek_height < 0.1:
-        cheek_height_label = 'low-set'
-    elif cheek_height < 0.2:
-        cheek_height_label = 'balanced'
-    else:
-        cheek_height_label = 'high-set'
-
+    cheek_prom_label, cheek_height_label = lab['cheek_prominence'], lab['cheek_height']
     result['cheekbones'] = {'prominence': cheek_prom_label, 'height': cheek_height_label,
-                            'definition': 'natural', 'metrics': {'prominence': cheek_prom, 'height_ratio': cheek_height}}
+                            'definition': 'natural',
+                            'metrics': {'prominence': v['cheekbone_prominence'], 'height_ratio': v['cheekbone_height']}}
     human_text.append(f"Your cheekbones are {cheek_prom_label} and {cheek_height_label}, giving your face well-structured contours.")
 
     return result, "\n".join(human_text)
+
+
+def classify_features_batch(metrics):
+    """Classify N faces at once; returns a list of (result, human_text) per face."""
+    values, labels = evaluate_rules(metrics)
+    n = len(values['face_ratio'])
+    return [_describe(row, values, labels) for row in range(n)]
+
+
+def classify_features(metrics):
+    """Classify one face from its Layer 2 metrics dict."""
+    return classify_features_batch(metrics)[0]
@@ -11,16 +11,16 @@ if __name__ == "__main__":
 
     try:
         # --- Extract landmarks ---
-        coords, img_shape = extract_landmarks(image_path)
+        landmarks, img_shape = extract_landmarks(image_path)
 
         # --- Save detected landmarks for accuracy checks ---
         detected_landmarks_path = r"C:\Users\user\Desktop\Final_Project\detected_landmarks.json"
         with open(detected_landmarks_path, 'w') as f:
-            json.dump({"landmarks": coords}, f, indent=4)
+            json.dump({"landmarks": landmarks.tolist()}, f)
         print(f"Detected landmarks saved at: {detected_landmarks_path}")
 
         # --- Calculate metrics ---
-        metrics = calculate_metrics(coords, img_shape)
+        metrics = calculate_metrics(landmarks, img_shape)
 
         # --- Classify features ---
         result_json, human_text = classify_features(metrics)
@@ -37,8 +37,7 @@ if __name__ == "__main__":
         run_generation(
             face_features_path=json_output_path,
             knowledge_path="./knowledge",
-            output_path="final_makeup_recommendations.json",
-            model_name="phi3"
+            output_path="final_makeup_recommendations.json"
         )
 
     except Exception as e:
@@ -0,0 +1,199 @@
+import os
+import math
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import httpx
+
+# ---------------------------
+# Config
+# ---------------------------
+# Generation models, most capable first. Calls go to the first model whose
+# recent p95 latency is within LLM_LATENCY_SLO and whose queue has room;
+# when none qualifies the template text is used without calling the LLM.
+LLM_MODELS = [m.strip() for m in os.getenv("LLM_MODELS", "phi3,llama3.2:1b").split(",") if m.strip()]
+# p95 seconds per LLM call a model may take before traffic moves down a tier
+LLM_LATENCY_SLO = float(os.getenv("LLM_LATENCY_SLO", 20))
+# Calls kept per model, and how long a call counts
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", 50))
+LLM_LATENCY_MAX_AGE = float(os.getenv("LLM_LATENCY_MAX_AGE", 300))
+# Share of recent calls that may fail before a model is routed around
+LLM_MAX_FAILURE_RATE = float(os.getenv("LLM_MAX_FAILURE_RATE", 0.2))
+# A model out of rotation gets one probe call this often; a probe that
+# succeeds within the SLO clears its history and puts it back
+LLM_PROBE_INTERVAL = float(os.getenv("LLM_PROBE_INTERVAL", 30))
+# In-flight calls per model (per web worker) before new calls move down a tier
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", 8))
+
+# Pseudo-model for the template-only tier
+TEMPLATE_MODEL = "template"
+
+# Fewer calls than this say nothing about p95 or the failure rate yet
+_MIN_SAMPLES = 5
+
+
+def _is_timeout(error):
+    return isinstance(error, (TimeoutError, httpx.TimeoutException))
+
+
+class _ModelStats:
+    """Rolling call outcomes and in-flight count for one model."""
+
+    def __init__(self, window):
+        self.samples = deque(maxlen=max(1, window))   # (finished_at, seconds, ok)
+        self.inflight = 0
+        self.last_probe = 0.0
+        self.probing = False
+
+    def expire(self, now, max_age):
+        while self.samples and now - self.samples[0][0] > max_age:
+            self.samples.popleft()
+
+    def p95(self):
+        """p95 seconds of the successful calls, or None with too few of them."""
+        ordered = sorted(seconds for _, seconds, ok in self.samples if ok)
+        if len(ordered) < _MIN_SAMPLES:
+            return None
+        return ordered[math.ceil(0.95 * len(ordered)) - 1]
+
+    def failure_rate(self):
+        if len(self.samples) < _MIN_SAMPLES:
+            return None
+        return sum(1 for _, _, ok in self.samples if not ok) / len(self.samples)
+
+
+class ModelTiers:
+    """Picks the generation model per LLM call from recent latency and load.
+
+    A model is eligible while, over its last ``window`` calls (younger than
+    ``max_age`` seconds), the p95 latency of successful calls is within
+    ``slo`` and fits in the caller's remaining budget, at most
+    ``max_failure_rate`` of the calls failed, and it has fewer than
+    ``max_inflight`` calls running. A model out of rotation for latency or
+    failures gets a probe call every ``probe_interval`` seconds.
+    """
+
+    def __init__(self, models=None, slo=LLM_LATENCY_SLO, window=LLM_LATENCY_WINDOW,
+                 max_age=LLM_LATENCY_MAX_AGE, max_inflight=LLM_MAX_INFLIGHT,
+                 max_failure_rate=LLM_MAX_FAILURE_RATE, probe_interval=LLM_PROBE_INTERVAL):
+        self.models = list(models if models is not None else LLM_MODELS)
+        self.slo = slo
+        self.max_age = max_age
+        self.max_inflight = max(1, max_inflight)
+        self.max_failure_rate = max_failure_rate
+        self.probe_interval = probe_interval
+        self._window = window
+        self._stats = {model: _ModelStats(window) for model in self.models}
+        self._lock = threading.Lock()
+
+    def _stats_for(self, model):
+        # Models passed explicitly by a caller are tracked too
+        if model not in self._stats:
+            self._stats[model] = _ModelStats(self._window)
+        return self._stats[model]
+
+    def _healthy(self, stats, now):
+        """Latency within the SLO and failures within the allowed rate."""
+        stats.expire(now, self.max_age)
+        p95 = stats.p95()
+        failure_rate = stats.failure_rate()
+        return (p95 is None or p95 <= self.slo) and \
+            (failure_rate is None or failure_rate <= self.max_failure_rate)
+
+    def _eligible(self, model, now, remaining):
+        stats = self._stats[model]
+        if stats.inflight >= self.max_inflight or not self._healthy(stats, now):
+            return False
+        p95 = stats.p95()
+        return p95 is None or remaining is None or p95 <= remaining
+
+    def _probe(self, model, now, remaining):
+        """Claim a probe call for an unhealthy, idle model whose interval has passed."""
+        stats = self._stats[model]
+        if stats.inflight or self._healthy(stats, now) or now - stats.last_probe < self.probe_interval:
+            return False
+        if remaining is not None and remaining < self.slo:
+            return False
+        stats.last_probe = now
+        stats.probing = True
+        return True
+
+    def choose(self, deadline=None):
+        """Return the model for the next call, or TEMPLATE_MODEL."""
+        remaining = deadline.remaining() if deadline else None
+        now = time.monotonic()
+        with self._lock:
+            for model in self.models:
+                if self._eligible(model, now, remaining) or self._probe(model, now, remaining):
+                    return model
+        return TEMPLATE_MODEL
+
+    @contextmanager
+    def track(self, model, deadline=None):
+        """Count a call as in flight and record its outcome.
+
+        A timeout of a call made under ``deadline`` is the caller's budget
+        running out, not a model failure (as for endpoint cooldown in
+        ollama_client). It only counts as a latency sample when the time
+        already spent exceeds the SLO.
+        """
+        with self._lock:
+            self._stats_for(model).inflight += 1
+        start = time.monotonic()
+        outcome = None   # (seconds, ok), or None to record nothing
+        try:
+            yield
+            outcome = (time.monotonic() - start, True)
+        except Exception as e:
+            elapsed = time.monotonic() - start
+            if deadline is None or not _is_timeout(e):
+                outcome = (elapsed, False)
+            elif elapsed > self.slo:
+                outcome = (elapsed, True)
+            raise
+        finally:
+            with self._lock:
+                stats = self._stats_for(model)
+                stats.inflight -= 1
+                if stats.probing:
+                    stats.probing = False
+                    if outcome is not None and outcome[1] and outcome[0] <= self.slo:
+                        # The model recovered; drop the history that excluded it
+                        stats.samples.clear()
+                if outcome is not None:
+                    stats.samples.append((time.monotonic(), *outcome))
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            report = []
+            for model, stats in self._stats.items():
+                stats.expire(now, self.max_age)
+                p95 = stats.p95()
+                failure_rate = stats.failure_rate()
+                report.append({
+                    "model": model,
+                    # None until there are enough recent calls
+                    "p95": p95 if p95 is None else round(p95, 3),
+                    "failure_rate": failure_rate if failure_rate is None else round(failure_rate, 3),
+                    "samples": len(stats.samples),
+                    "inflight": stats.inflight,
+                    "eligible": model in self.models and self._eligible(model, now, None),
+                })
+            return report
+
+
+_tiers = None
+_tiers_lock = threading.Lock()
+
+
+def get_model_tiers():
+    """Return the process-wide model tiers, creating them on first call."""
+    global _tiers
+    if _tiers is None:
+        with _tiers_lock:
+            if _tiers is None:
+                _tiers = ModelTiers()
+    return _tiers
@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import threading
+
+import httpx
+
+# ---------------------------
+# Config
+# ---------------------------
+# Comma-separated Ollama base URLs; requests go to the healthy one with the
+# lowest expected latency
+OLLAMA_HOSTS = [
+    h.strip() for h in os.getenv("OLLAMA_HOSTS", os.getenv("OLLAMA_HOST", "http://localhost:11434")).split(",")
+    if h.strip()
+]
+# How long the host keeps the model loaded after each request
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# Default model options sent with every chat (merged under per-call options)
+OLLAMA_OPTIONS = {"num_ctx": int(os.getenv("OLLAMA_NUM_CTX", 2048))}
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", 120))
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", 8))
+# An endpoint that failed is skipped for this many seconds
+OLLAMA_COOLDOWN = float(os.getenv("OLLAMA_COOLDOWN", 30))
+
+# Weight of the newest sample in the moving latency average
+_EWMA_ALPHA = 0.3
+
+
+class OllamaError(Exception):
+    """Raised when Ollama answers with an error, or no endpoint is reachable."""
+
+
+class Endpoint:
+    """One Ollama host: a pooled keep-alive HTTP session plus health stats."""
+
+    def __init__(self, host, timeout=OLLAMA_TIMEOUT, max_connections=OLLAMA_MAX_CONNECTIONS):
+        self.host = host.rstrip("/")
+        self.session = httpx.Client(
+            base_url=self.host,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+        self.latency = None      # EWMA of seconds until response headers
+        self.inflight = 0
+        self.failures = 0
+        self.down_until = 0.0
+        self._lock = threading.Lock()
+
+    def healthy(self, now=None):
+        return (now or time.monotonic()) >= self.down_until
+
+    def score(self):
+        # Unknown endpoints are tried first so every host gets measured
+        return (self.latency or 0.0) * (1 + self.inflight)
+
+    def begin(self):
+        with self._lock:
+            self.inflight += 1
+
+    def end(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def succeeded(self, seconds):
+        with self._lock:
+            self.failures = 0
+            self.down_until = 0.0
+            self.latency = seconds if self.latency is None else \
+                _EWMA_ALPHA * seconds + (1 - _EWMA_ALPHA) * self.latency
+
+    def failed(self, cooldown=OLLAMA_COOLDOWN):
+        with self._lock:
+            self.failures += 1
+            self.down_until = time.monotonic() + cooldown
+
+    def stats(self):
+        return {
+            "host": self.host,
+            "healthy": self.healthy(),
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+            "inflight": self.inflight,
+            "failures": self.failures,
+        }
+
+
+class OllamaRouter:
+    """Chat client over one or more Ollama endpoints.
+
+    Every request carries ``keep_alive`` and the default options. Endpoints
+    are chosen by moving-average latency weighted by in-flight requests;
+    one that fails to connect or answers 5xx is put on cooldown and the
+    request moves to the next endpoint.
+    """
+
+    def __init__(self, hosts=None, keep_alive=OLLAMA_KEEP_ALIVE, options=None,
+                 timeout=OLLAMA_TIMEOUT, cooldown=OLLAMA_COOLDOWN):
+        self.endpoints = [Endpoint(host, timeout=timeout) for host in (hosts or OLLAMA_HOSTS)]
+        if not self.endpoints:
+            raise ValueError("No Ollama endpoints configured")
+        self.keep_alive = keep_alive
+        self.options = dict(OLLAMA_OPTIONS if options is None else options)
+        self.cooldown = cooldown
+
+    def _candidates(self):
+        now = time.monotonic()
+        healthy = sorted((e for e in self.endpoints if e.healthy(now)), key=Endpoint.score)
+        # With every endpoint cooling down, try the one that recovers first
+        return healthy or sorted(self.endpoints, key=lambda e: e.down_until)
+
+    def _send(self, path, payload, stream, timeout):
+        """POST to the best endpoint, failing over; returns (endpoint, open response)."""
+        errors = []
+        for endpoint in self._candidates():
+            request = endpoint.session.build_request(
+                "POST", path, json=payload, timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
+            )
+            endpoint.begin()
+            start = time.monotonic()
+            try:
+                response = endpoint.session.send(request, stream=stream)
+            except httpx.TimeoutException:
+                # A caller's budget running out says little about the host, and
+                # leaves no time to fail over; the client default timing out does
+                endpoint.end()
+                if timeout is None:
+                    endpoint.failed(self.cooldown)
+                raise
+            except httpx.TransportError as e:
+                endpoint.end()
+                endpoint.failed(self.cooldown)
+                errors.append(f"{endpoint.host}: {e}")
+                continue
+            if response.status_code >= 500:
+                detail = response.read().decode("utf-8", "replace")[:200]
+                response.close()
+                endpoint.end()
+                endpoint.failed(self.cooldown)
+                errors.append(f"{endpoint.host}: HTTP {response.status_code} {detail}")
+                continue
+            endpoint.succeeded(time.monotonic() - start)
+            if response.status_code >= 400:
+                detail = response.read().decode("utf-8", "replace")
+                response.close()
+                endpoint.end()
+                raise OllamaError(f"{endpoint.host}: HTTP {response.status_code} {detail}")
+            return endpoint, response
+        raise OllamaError("No Ollama endpoint available: " + "; ".join(errors))
+
+    def _payload(self, model, options, **fields):
+        payload = {"model": model, "keep_alive": self.keep_alive, "options": {**self.options, **(options or {})}}
+        payload.update({k: v for k, v in fields.items() if v is not None})
+        return payload
+
+    def chat(self, model, messages, stream=False, format=None, options=None, timeout=None):
+        """POST /api/chat. Returns the response dict, or an iterator of chunk dicts
+        with ``stream=True`` (closing it drops the connection, which stops
+        generation on the host). ``timeout`` overrides the client default.
+        """
+        payload = self._payload(model, options, messages=messages, stream=stream, format=format)
+        endpoint, response = self._send("/api/chat", payload, stream, timeout)
+        if not stream:
+            try:
+                return _check(response.json())
+            finally:
+                response.close()
+                endpoint.end()
+        return _iter_chunks(endpoint, response)
+
+    def warm_up(self, model):
+        """Load ``model`` on every endpoint (an empty generate) so the first user skips the load."""
+        for endpoint in self.endpoints:
+            start = time.monotonic()
+            try:
+                response = endpoint.session.post(
+                    "/api/generate", json={"model": model, "keep_alive": self.keep_alive}
+                )
+                response.raise_for_status()
+                endpoint.succeeded(time.monotonic() - start)
+                print(f"[INFO] Ollama {endpoint.host}: {model} loaded in {time.monotonic() - start:.1f}s")
+            except Exception as e:
+                endpoint.failed(self.cooldown)
+                print(f"[WARN] Ollama {endpoint.host}: warm-up failed: {e}")
+
+    def health(self):
+        return [endpoint.stats() for endpoint in self.endpoints]
+
+    def close(self):
+        for endpoint in self.endpoints:
+            endpoint.session.close()
+
+
+def _check(chunk):
+    if "error" in chunk:
+        raise OllamaError(chunk["error"])
+    return chunk
+
+
+def _iter_chunks(endpoint, response):
+    try:
+        for line in response.iter_lines():
+            if line:
+                yield _check(json.loads(line))
+    finally:
+        response.close()
+        endpoint.end()
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    """Return the process-wide Ollama router, creating it on first call."""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = OllamaRouter()
+    return _router
+
+
+def warm_up_ollama(model, background=True):
+    """Ping every endpoint with ``model`` (in a daemon thread unless ``background=False``)."""
+    if not background:
+        get_router().warm_up(model)
+        return
+    threading.Thread(target=get_router().warm_up, args=(model,), name="ollama-warm-up", daemon=True).start()
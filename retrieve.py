@@ -1,36 +1,56 @@
 import os
 import json
-import chromadb
+import hashlib
+import threading
+from functools import lru_cache
+import numpy as np
 from sentence_transformers import SentenceTransformer
+from knowledge_bundle import BUNDLE_PATH, load_bundle
+from layer3_classify import LABELS
+
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
 
 # -----------------------------
-# ChromaDB setup  (per-request, in-memory – no stale-UUID races)
+# In-memory knowledge index  (built once per process, swapped atomically on change)
 # -----------------------------
-_client = None
-_collection = None
+class KnowledgeIndex:
+    """Immutable snapshot of the embedded knowledge base.
+
+    Holds the document metadata next to the float32 embedding matrix (possibly
+    a read-only memory map from the knowledge bundle) so a whole batch of
+    queries can be scored in one vectorized pass.
+    """
 
+    def __init__(self, content_hash, docs, embeddings, query_table=None):
+        self.content_hash = content_hash
+        # query string -> precomputed embedding for every classifier-produced intent
+        self.query_table = query_table or {}
+        self.metadatas = [metadata for _, _, metadata in docs]
+        self.embeddings = embeddings
+        self.sq_norms = np.einsum("ij,ij->i", embeddings, embeddings)
+        self.features = np.array([m["feature"] for m in self.metadatas], dtype=object)
+        self.variants = np.array([m["variant"] for m in self.metadatas], dtype=object)
+        self.steps = [_parse_steps(m.get("steps")) for m in self.metadatas]
 
-def _get_collection(reset=False):
-    """Return the in-memory ChromaDB collection, creating it on first call.
+        # (feature, variant) -> doc positions, for O(1) exact lookups
+        self.by_key = {}
+        for i, m in enumerate(self.metadatas):
+            self.by_key.setdefault((m["feature"], m["variant"]), []).append(i)
+
+    def __len__(self):
+        return len(self.metadatas)
+
+
+_index = None             # active, fully built KnowledgeIndex – read by requests
+_index_lock = threading.Lock()
 
-    Parameters
-    ----------
-    reset : bool
-        If True, drop the existing collection and create a fresh one
-        (used before re-indexing the knowledge base).
-    """
-    global _client, _collection
-    if _client is None:
-        _client = chromadb.EphemeralClient()
-    if reset:
-        try:
-            _client.delete_collection("features")
-        except Exception:
-            pass
-        _collection = _client.create_collection(name="features")
-    elif _collection is None:
-        _collection = _client.get_or_create_collection(name="features")
-    return _collection
+
+def _get_index():
+    """Return the active knowledge index, indexing the default folder if needed."""
+    index = _index
+    if index is None:
+        index = index_knowledge()
+    return index
 
 # -----------------------------
 # Helpers
@@ -38,15 +58,106 @@ def _get_collection(reset=False):
 def normalize(text):
     return text.strip().lower().replace(" ", "_") if isinstance(text, str) else ""
 
+
+def _parse_steps(raw):
+    if not raw:
+        return []
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return []
+
+
+def _knowledge_files(json_folder):
+    return sorted(f for f in os.listdir(json_folder) if f.endswith(".json"))
+
+
+def knowledge_hash(json_folder="./knowledge"):
+    """SHA-256 over the names and contents of every knowledge JSON file."""
+    digest = hashlib.sha256()
+    for filename in _knowledge_files(json_folder):
+        digest.update(filename.encode("utf-8"))
+        with open(os.path.join(json_folder, filename), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+# folder -> (stat signature, digest), so index_knowledge only re-reads the
+# files when one was added, removed or modified
+_hash_cache = {}
+
+
+def _stat_signature(json_folder):
+    signature = []
+    for filename in _knowledge_files(json_folder):
+        st = os.stat(os.path.join(json_folder, filename))
+        signature.append((filename, st.st_mtime_ns, st.st_size))
+    return tuple(signature)
+
+
+def cached_knowledge_hash(json_folder="./knowledge"):
+    """knowledge_hash, re-hashed only when a file's name, mtime or size changes."""
+    signature = _stat_signature(json_folder)
+    cached = _hash_cache.get(json_folder)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    digest = knowledge_hash(json_folder)
+    _hash_cache[json_folder] = (signature, digest)
+    return digest
+
+# -----------------------------
+# Embeddings
+# -----------------------------
+# The SentenceTransformer (~80 MB) is only loaded when something actually
+# needs embedding: a missing/stale bundle or a query outside the lookup table.
+_embedding_model = None
+_model_lock = threading.Lock()
+
+
+def get_embedding_model():
+    global _embedding_model
+    if _embedding_model is None:
+        with _model_lock:
+            if _embedding_model is None:
+                print(f"[INFO] Loading embedding model {EMBEDDING_MODEL_NAME}...")
+                _embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    return _embedding_model
+
+
+def embed_documents(documents):
+    """Embed texts as a float32 (n, dim) matrix."""
+    model = get_embedding_model()
+    if not documents:
+        return np.zeros((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+    return np.asarray(model.encode(documents), dtype=np.float32)
+
+
+@lru_cache(maxsize=1024)
+def _embed_uncached_query(query):
+    vector = embed_documents([query])[0]
+    vector.setflags(write=False)
+    return vector
+
+
+def embed_queries(index, queries):
+    """Embed ``queries`` from the index's precomputed table, or the LRU cache on a miss."""
+    return np.stack([
+        index.query_table[q] if q in index.query_table else _embed_uncached_query(q)
+        for q in queries
+    ])
+
 # -----------------------------
 # Knowledge indexing
 # -----------------------------
-def index_knowledge(json_folder="./knowledge"):
-    col = _get_collection(reset=True)   # fresh collection each indexing run
-    for filename in os.listdir(json_folder):
-        if not filename.endswith(".json"):
-            continue
+def load_knowledge(json_folder="./knowledge"):
+    """Read and normalize every knowledge entry.
 
+    Returns
+    -------
+    list of (doc_id, document, metadata) tuples, one per usable entry.
+    """
+    docs = []
+    for filename in _knowledge_files(json_folder):
         path = os.path.join(json_folder, filename)
         with open(path, "r", encoding="utf-8") as f:
             data = json.load(f)
@@ -63,18 +174,67 @@ def index_knowledge(json_folder="./knowledge"):
                 continue
 
             doc_id = f"{feature}_{variant}_{i}"
-
-            col.add(
-                documents=[" ".join(steps)],
-                metadatas=[{
+            docs.append((
+                doc_id,
+                " ".join(steps),
+                {
                     "id": doc_id,
                     "feature": feature,
                     "variant": variant,
                     "technique": item.get("technique", ""),
                     "steps": json.dumps(steps, ensure_ascii=False)
-                }],
-                ids=[doc_id]
-            )
+                }
+            ))
+    return docs
+
+
+def _load_or_embed(json_folder, digest, bundle_path):
+    """Return (docs, embeddings, query_table) from the bundle, embedding whatever is missing."""
+    bundle = load_bundle(bundle_path, EMBEDDING_MODEL_NAME, digest) if bundle_path else None
+    if bundle is not None:
+        print(f"[INFO] Loaded knowledge bundle from {bundle_path}")
+        docs, embeddings, query_table = bundle
+    else:
+        print("[INFO] No usable knowledge bundle, embedding documents live...")
+        docs = load_knowledge(json_folder)
+        embeddings = embed_documents([document for _, document, _ in docs])
+        query_table = {}
+
+    missing = [q for q in dict.fromkeys(all_intent_queries()) if q not in query_table]
+    if missing:
+        query_table = dict(query_table)
+        query_table.update(zip(missing, embed_documents(missing)))
+    return docs, embeddings, query_table
+
+
+def index_knowledge(json_folder="./knowledge", force=False, bundle_path=BUNDLE_PATH):
+    """Build the knowledge index, at most once per knowledge version.
+
+    The index is rebuilt only when the content hash of ``json_folder``
+    changes (or ``force`` is set); the files are only re-hashed when their
+    names, mtimes or sizes change. Document embeddings come from the
+    precompiled bundle at ``bundle_path`` when it matches the current model
+    and content hash (see knowledge_bundle.py), otherwise they are computed
+    live. A new index is fully built before it replaces the active one, so
+    concurrent queries never see a half-built index.
+    """
+    global _index
+    # Called per request, so only the files' stat data is read when nothing changed
+    digest = cached_knowledge_hash(json_folder)
+    current = _index
+    if not force and current is not None and current.content_hash == digest:
+        return current
+
+    with _index_lock:
+        current = _index
+        if not force and current is not None and current.content_hash == digest:
+            return current
+
+        print(f"[INFO] Indexing knowledge base ({digest[:12]})...")
+        docs, embeddings, query_table = _load_or_embed(json_folder, digest, bundle_path)
+        index = KnowledgeIndex(digest, docs, embeddings, query_table)
+        _index = index
+        return index
 
 # -----------------------------
 # Load face features
@@ -86,140 +246,122 @@ def load_face_features(path):
 # -----------------------------
 # Build retrieval intents
 # -----------------------------
+# (knowledge feature, face_features section, field, query template)
+INTENT_SPECS = [
+    ("nose", "nose", "tip", "{} nose contour technique"),
+    ("eyes", "eyes", "shape", "{} eyes makeup technique"),
+    ("face_shape", "face_shape", "primary", "{} face makeup technique"),
+    ("lips", "lips", "fullness", "{} lips makeup technique"),
+    ("brows", "eyebrows", "arch", "{} eyebrow shaping"),
+    ("jawline", "jaw_chin", "jaw", "{} jawline contour technique"),
+    ("chin", "jaw_chin", "chin_shape", "{} chin contour technique"),
+    ("cheekbones", "cheekbones", "prominence", "{} cheekbone makeup technique"),
+]
+
+
 def build_feature_queries(face_features):
     intents = []
+    for feature, section, field, template in INTENT_SPECS:
+        label = face_features.get(section, {}).get(field)
+        if label:
+            intents.append({
+                "feature": feature,
+                "variant": normalize(label),
+                "query": template.format(label)
+            })
+    return intents
 
-    # Nose
-    nose = face_features.get("nose", {})
-    if nose.get("tip"):
-        intents.append({
-            "feature": "nose",
-            "variant": normalize(nose["tip"]),
-            "query": f"{nose['tip']} nose contour technique"
-        })
-
-    # Eyes
-    eyes = face_features.get("eyes", {})
-    if eyes.get("shape"):
-        intents.append({
-            "feature": "eyes",
-            "variant": normalize(eyes["shape"]),
-            "query": f"{eyes['shape']} eyes makeup technique"
-        })
-
-    # Face shape
-    face = face_features.get("face_shape", {})
-    if face.get("primary"):
-        intents.append({
-            "feature": "face_shape",
-            "variant": normalize(face["primary"]),
-            "query": f"{face['primary']} face makeup technique"
-        })
-
-    # Lips
-    lips = face_features.get("lips", {})
-    if lips.get("fullness"):
-        intents.append({
-            "feature": "lips",
-            "variant": normalize(lips["fullness"]),
-            "query": f"{lips['fullness']} lips makeup technique"
-        })
-
-    # Brows
-    brows = face_features.get("eyebrows", {})
-    if brows.get("arch"):
-        intents.append({
-            "feature": "brows",
-            "variant": normalize(brows["arch"]),
-            "query": f"{brows['arch']} eyebrow shaping"
-        })
-
-    # Jawline
-    jaw = face_features.get("jaw_chin", {}).get("jaw", "")
-    if jaw:
-        intents.append({
-            "feature": "jawline",
-            "variant": normalize(jaw),
-            "query": f"{jaw} jawline contour technique"
-        })
-
-    # Chin
-    chin = face_features.get("jaw_chin", {}).get("chin_shape", "")
-    if chin:
-        intents.append({
-            "feature": "chin",
-            "variant": normalize(chin),
-            "query": f"{chin} chin contour technique"
-        })
-
-    # Cheekbones
-    cheeks = face_features.get("cheekbones", {})
-    if cheeks.get("prominence"):
-        intents.append({
-            "feature": "cheekbones",
-            "variant": normalize(cheeks["prominence"]),
-            "query": f"{cheeks['prominence']} cheekbone makeup technique"
-        })
 
-    return intents
+def all_intent_queries():
+    """Every query string build_feature_queries can produce for classifier output."""
+    return [
+        template.format(label)
+        for _, section, field, template in INTENT_SPECS
+        for label in LABELS.get((section, field), ())
+    ]
 
 # -----------------------------
 # Retrieval
 # -----------------------------
-embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
+
+def _squared_l2(index, query_embeddings):
+    """(n_queries, n_docs) squared L2 distances, matching Chroma's default space."""
+    q = np.asarray(query_embeddings, dtype=np.float32)
+    q_sq = np.einsum("ij,ij->i", q, q)
+    return q_sq[:, None] + index.sq_norms[None, :] - 2.0 * (q @ index.embeddings.T)
+
+
+def _result(index, doc_id, distance):
+    meta = index.metadatas[doc_id]
+    return {
+        "feature": meta["feature"],
+        "variant": meta["variant"],
+        "technique": meta.get("technique", ""),
+        "steps": list(index.steps[doc_id]),
+        "distance": distance
+    }
+
+
+def _semantic_search(index, intents, top_k):
+    """Nearest documents for ``intents`` in one batched encode + matrix pass.
+
+    Each intent keeps its ``top_k`` nearest documents with a matching feature
+    and variant, falling back to any document of the same feature.
+    """
+    embeddings = embed_queries(index, [intent["query"] for intent in intents])
+    distances = _squared_l2(index, embeddings)
+
+    intent_features = np.array([normalize(i["feature"]) for i in intents], dtype=object)
+    intent_variants = np.array([normalize(i["variant"]) for i in intents], dtype=object)
+    feature_mask = intent_features[:, None] == index.features[None, :]
+    variant_mask = feature_mask & (intent_variants[:, None] == index.variants[None, :])
+
+    # fallback: feature-only for intents with no exact variant in the knowledge base
+    mask = np.where(variant_mask.any(axis=1, keepdims=True), variant_mask, feature_mask)
+    distances = np.where(mask, distances, np.inf)
+    ranked = np.argsort(distances, axis=1, kind="stable")[:, :top_k]
+
+    results = []
+    for row, doc_ids in enumerate(ranked):
+        results.append([
+            _result(index, doc_id, float(distances[row, doc_id]))
+            for doc_id in doc_ids if mask[row, doc_id]
+        ])
+    return results
+
 
 def retrieve_from_face_features(face_features, top_k=1):
-    col = _get_collection()              # reuse the already-indexed collection
-    intents = build_feature_queries(face_features)
-    seen = set()
-    results_all = []
-
-    for intent in intents:
-        key = (intent["feature"], intent["variant"])
-        if key in seen:
-            continue
-        seen.add(key)
-
-        embedding = embedding_model.encode(intent["query"]).tolist()
-
-        # Try feature + variant
-        results = col.query(
-            query_embeddings=[embedding],
-            n_results=top_k,
-            where={
-                "$and": [
-                    {"feature": normalize(intent["feature"])},
-                    {"variant": normalize(intent["variant"])}
-                ]
-            }
-        )
-
-        # fallback: feature-only
-        if not results["documents"][0]:
-            results = col.query(
-                query_embeddings=[embedding],
-                n_results=top_k,
-                where={"feature": normalize(intent["feature"])}
-            )
-
-        for doc, meta, dist in zip(
-            results["documents"][0],
-            results["metadatas"][0],
-            results["distances"][0]
-        ):
-            steps = []
-            if meta.get("steps"):
-                try:
-                    steps = json.loads(meta["steps"])
-                except:
-                    steps = []
-
-            results_all.append({
-                "feature": meta["feature"],
-                "variant": meta["variant"],
-                "technique": meta.get("technique", ""),
-                "steps": steps,   # ✅ must exist now
-                "distance": dist
-            })
+    """Retrieve the best technique per intent.
 
-    return results_all
+    Intents whose (feature, variant) exists in the knowledge base are answered
+    straight from the hash index with distance 0.0. Only the remaining
+    intents (unknown variants) go through semantic search, batched into a
+    single embedding call.
+    """
+    index = _get_index()                 # snapshot of the active index
+    seen = set()
+    intents = []
+    for intent in build_feature_queries(face_features):
+        key = (normalize(intent["feature"]), normalize(intent["variant"]))
+        if key not in seen:
+            seen.add(key)
+            intents.append((key, intent))
+
+    if not intents or not len(index):
+        return []
+
+    per_intent = [None] * len(intents)
+    misses = []
+    for pos, (key, intent) in enumerate(intents):
+        doc_ids = index.by_key.get(key)
+        if doc_ids:
+            per_intent[pos] = [_result(index, doc_id, 0.0) for doc_id in doc_ids[:top_k]]
+        else:
+            misses.append(pos)
+
+    if misses:
+        found = _semantic_search(index, [intents[pos][1] for pos in misses], top_k)
+        for pos, results in zip(misses, found):
+            per_intent[pos] = results
+
+    return [result for results in per_intent for result in results]
@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import argparse
+from collections import deque
+
+import cv2
+import mediapipe as mp
+import numpy as np
+
+from landmarker_pool import create_landmarker
+from layer1_extraction import TARGET_SIZE, landmark_array
+from layer2_metrics import LANDMARK_INDICES, calculate_metrics_batch
+from layer3_classify import classify_features
+
+# Frames averaged per landmark (smoothing) and per stability check
+SMOOTHING_WINDOW = int(os.getenv("VIDEO_SMOOTHING_WINDOW", 5))
+STABILITY_WINDOW = int(os.getenv("VIDEO_STABILITY_WINDOW", 15))
+# Consecutive frames without a face after which the smoothing state is dropped
+MAX_MISSED_FRAMES = 10
+
+# Pixel sizes change with distance to the camera; only ratios and angles
+# have to settle before the face is classified
+_UNSTABLE_OK = {"face_width", "face_height"}
+# A metric is stable when its std over the window is within
+# rel * |mean| + abs (abs is in degrees for brow angles)
+_REL_TOLERANCE = 0.03
+_ABS_TOLERANCE = {"left_brow_angle": 1.0, "right_brow_angle": 1.0}
+_DEFAULT_ABS_TOLERANCE = 0.005
+
+
+class LandmarkSmoother:
+    """Moving average of the last ``window`` landmark arrays."""
+
+    def __init__(self, window=SMOOTHING_WINDOW):
+        self._frames = deque(maxlen=max(1, window))
+
+    def update(self, landmarks):
+        self._frames.append(landmarks)
+        return np.mean(self._frames, axis=0, dtype=np.float64).astype(np.float32)
+
+    def reset(self):
+        self._frames.clear()
+
+
+class StabilityTracker:
+    """Tracks per-frame metrics and reports when they have settled."""
+
+    def __init__(self, window=STABILITY_WINDOW):
+        self._window = max(2, window)
+        self._history = deque(maxlen=self._window)
+
+    def update(self, metrics):
+        self._history.append(metrics)
+        return self.is_stable()
+
+    def reset(self):
+        self._history.clear()
+
+    def is_stable(self):
+        if len(self._history) < self._window:
+            return False
+        for name in self._history[0]:
+            if name in _UNSTABLE_OK:
+                continue
+            values = np.array([m[name] for m in self._history])
+            tolerance = _REL_TOLERANCE * abs(values.mean()) + _ABS_TOLERANCE.get(name, _DEFAULT_ABS_TOLERANCE)
+            if not np.isfinite(values).all() or values.std() > tolerance:
+                return False
+        return True
+
+    def mean_metrics(self):
+        return {name: float(np.mean([m[name] for m in self._history])) for name in self._history[0]}
+
+
+def read_frames(source):
+    """Yield ``(timestamp_ms, frame_bgr)`` from a video file path or camera index."""
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video source: {source}")
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    try:
+        index = 0
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                return
+            position = capture.get(cv2.CAP_PROP_POS_MSEC)
+            yield (int(position) if position > 0 else int(index * 1000 / fps)), frame
+            index += 1
+    finally:
+        capture.release()
+
+
+def analyze_frames(frames, stop_when_stable=True, max_frames=None,
+                   smoothing_window=SMOOTHING_WINDOW, stability_window=STABILITY_WINDOW):
+    """Run Layers 1–3 over a stream of ``(timestamp_ms, frame_bgr)``.
+
+    A single FaceLandmarker in VIDEO mode tracks the face between frames.
+    Landmarks are smoothed over ``smoothing_window`` frames, and the face
+    is classified from the metrics averaged over the last
+    ``stability_window`` frames once they have settled.
+
+    Returns a report with frame counts, fps and, if the metrics settled,
+    ``face_features`` / ``human_readable`` as in /analyze.
+    """
+    smoother = LandmarkSmoother(smoothing_window)
+    tracker = StabilityTracker(stability_window)
+    processed = with_face = missed = 0
+    stable_at = None
+    last_timestamp = -1
+
+    start = time.perf_counter()
+    landmarker = create_landmarker(mp.tasks.vision.RunningMode.VIDEO)
+    try:
+        for timestamp_ms, frame in frames:
+            if max_frames is not None and processed >= max_frames:
+                break
+            processed += 1
+
+            # VIDEO mode requires strictly increasing timestamps
+            timestamp_ms = max(int(timestamp_ms), last_timestamp + 1)
+            last_timestamp = timestamp_ms
+
+            resized = cv2.resize(frame, (TARGET_SIZE, TARGET_SIZE))
+            rgb_image = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
+            mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=rgb_image)
+            result = landmarker.detect_for_video(mp_image, timestamp_ms)
+
+            if not result.face_landmarks:
+                missed += 1
+                if missed >= MAX_MISSED_FRAMES:
+                    smoother.reset()
+                    tracker.reset()
+                continue
+            missed = 0
+            with_face += 1
+
+            landmarks = landmark_array(result.face_landmarks[0], TARGET_SIZE, TARGET_SIZE, LANDMARK_INDICES)
+            smoothed = smoother.update(landmarks)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                batch = calculate_metrics_batch(smoothed[None])
+            metrics = {name: values[0].item() for name, values in batch.items()}
+
+            if tracker.update(metrics) and stable_at is None:
+                stable_at = processed
+                if stop_when_stable:
+                    break
+    finally:
+        landmarker.close()
+    elapsed = time.perf_counter() - start
+
+    report = {
+        "frames": processed,
+        "frames_with_face": with_face,
+        "seconds": round(elapsed, 3),
+        "fps": round(processed / elapsed, 2) if elapsed > 0 else None,
+        "stable": stable_at is not None,
+        "stable_at_frame": stable_at,
+    }
+    if stable_at is None:
+        print(f"[WARN] Metrics did not stabilize over {processed} frames")
+        return report
+
+    face_features, human_text = classify_features(tracker.mean_metrics())
+    report.update(face_features=face_features, human_readable=human_text)
+    return report
+
+
+def analyze_video(source, **kwargs):
+    """analyze_frames over a video file path or camera index (e.g. 0 for a webcam)."""
+    return analyze_frames(read_frames(source), **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify a face from a short video or webcam stream.")
+    parser.add_argument("source", help="video file path, or a camera index such as 0")
+    parser.add_argument("--max-frames", type=int, default=None, help="stop after this many frames")
+    parser.add_argument("--full", action="store_true", help="process the whole video instead of stopping once stable")
+    parser.add_argument("--out", default=None, help="write the report JSON here")
+    args = parser.parse_args()
+
+    source = int(args.source) if args.source.isdigit() else args.source
+    report = analyze_video(source, stop_when_stable=not args.full, max_frames=args.max_frames)
+
+    print(f"[INFO] {report['frames']} frames in {report['seconds']}s ({report['fps']} fps), "
+          f"{report['frames_with_face']} with a face")
+    if report["stable"]:
+        print(f"[INFO] Metrics stable at frame {report['stable_at_frame']}")
+        print("\nHuman-Readable Description:\n", report["human_readable"])
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+        print(f"[INFO] Report saved at: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
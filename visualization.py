@@ -0,0 +1,73 @@
+import os
+import cv2
+import mediapipe as mp
+import numpy as np
+
+# Debug rendering of Layer 1 results. Nothing here runs on the inference
+# path; it is used by the CLI (show/save steps) and /analyze/debug.
+
+OUTPUT_DIR = "preprocessing_outputs"
+
+
+def draw_mesh(resized, landmarks):
+    """Draw the tessellation and landmark dots on a copy of ``resized``.
+
+    ``landmarks`` is Layer 1's (478, 3) array; unfilled (NaN) sparse rows
+    are skipped.
+    """
+    annotated = resized.copy()
+    filled = ~np.isnan(landmarks[:, 0])
+    points = np.where(filled[:, None], landmarks[:, :2], 0).astype(np.int32)
+
+    connections = mp.tasks.vision.FaceLandmarksConnections.FACE_LANDMARKS_TESSELATION
+    for conn in connections:
+        if filled[conn.start] and filled[conn.end]:
+            cv2.line(annotated, tuple(points[conn.start]), tuple(points[conn.end]), (192, 192, 192), 1)
+
+    # Highlight all landmarks (small green dots)
+    for idx in np.flatnonzero(filled):
+        x, y = points[idx]
+        cv2.circle(annotated, (x, y), 1, (0, 255, 0), -1)
+        if idx % 25 == 0:
+            cv2.putText(
+                annotated,
+                str(idx),
+                (x + 2, y + 2),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.25,
+                (0, 255, 255),
+                1
+            )
+    return annotated
+
+
+def render_png(resized, landmarks):
+    """Annotated mesh image encoded as PNG bytes."""
+    ok, buf = cv2.imencode(".png", draw_mesh(resized, landmarks))
+    if not ok:
+        raise RuntimeError("Could not encode debug image")
+    return buf.tobytes()
+
+
+def preprocessing_steps(original, resized, landmarks, show_steps=True, save_steps=True, output_dir=OUTPUT_DIR):
+    """Save and/or display each preprocessing stage of Layer 1."""
+    if not (show_steps or save_steps):
+        return
+
+    rgb_image = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
+    annotated = draw_mesh(resized, landmarks)
+
+    if save_steps:
+        os.makedirs(output_dir, exist_ok=True)
+        cv2.imwrite(f"{output_dir}/1_original.jpg", original)
+        cv2.imwrite(f"{output_dir}/2_resized.jpg", resized)
+        cv2.imwrite(f"{output_dir}/3_rgb.jpg", cv2.cvtColor(rgb_image, cv2.COLOR_RGB2BGR))
+        cv2.imwrite(f"{output_dir}/4_face_mesh_landmarks.jpg", annotated)
+
+    if show_steps:
+        cv2.imshow("1. Original Image", original)
+        cv2.imshow("2. Resized Image", resized)
+        cv2.imshow("3. RGB Converted Image", rgb_image)
+        cv2.imshow("4. Face Mesh & All Landmarks", annotated)
+        cv2.waitKey(0)
+        cv2.destroyAllWindows()